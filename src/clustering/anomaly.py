@@ -1,34 +1,62 @@
+import logging
+import math
 import numpy as np
 import pandas as pd
+from scipy.special import expit
+from scipy.sparse import csr_matrix
 from src.dataloader import BasicDataset
-from src.similarity import UserSimilarity
-from bitarray import bitarray
-import src.utils as utils
-
+from src.similarity import UserSimilarity, popcount, bitwise_and_count, bitwise_or_count
+
+try:
+    from numba import njit, prange
+    _numba = True
+except ImportError:
+    logging.getLogger("Logger").info("numba not installed, single user and userwise anomaly scores will not be compiled")
+    _numba = False
+
+# Maximum number of cluster members flattened at once by userwise_anomaly_scores
+USERWISE_CHUNK_USERS = 2**22
+# Number of users whose bitsets make_group intersects at once before checking if the intersection is empty
+MAKE_GROUP_CHUNK_USERS = 64
+# Group value sums gather all users at once if groups have at most this many users on average
+GROUP_SUMS_GATHER_FACTOR = 32
 
 class AnomalyGroup:
 
     def __init__(self, 
-                 users: list, 
-                 group_product_set_intersection: bitarray, 
-                 group_product_set_union: bitarray, 
+                 users: np.ndarray, 
+                 group_product_set_intersection: np.ndarray, 
+                 group_product_set_union: np.ndarray, 
                  n_total_reviews: int, 
                  user_simi: UserSimilarity, 
                  child1: 'AnomalyGroup'= None, 
-                 child2: 'AnomalyGroup' = None):
+                 child2: 'AnomalyGroup' = None,
+                 n_total_products_reviewed: int = None,
+                 n_common_products_reviewed: int = None,
+                 children: list['AnomalyGroup'] = None):
         self.users = users
         self.group_product_set_intersection = group_product_set_intersection
         self.group_product_set_union = group_product_set_union
-        self.n_total_products_reviewed = group_product_set_union.count()
-        self.n_common_products_reviewed = group_product_set_intersection.count()
-        self.n_users = len(users)
+        # Set bits are only counted here if the caller did not already count them
+        if n_total_products_reviewed is None:
+            n_total_products_reviewed = int(popcount(group_product_set_union))
+        if n_common_products_reviewed is None:
+            n_common_products_reviewed = int(popcount(group_product_set_intersection))
+        self.n_total_products_reviewed = n_total_products_reviewed
+        self.n_common_products_reviewed = n_common_products_reviewed
+        self.n_users = users.shape[0]
         self.n_total_reviews = n_total_reviews
         self.user_simi = user_simi
         self.child1 = child1
         self.child2 = child2
+        # All children of the group, in the order their users appear in users
+        if children is None:
+            children = [child for child in (child1, child2) if child is not None]
+        self.children = children
 
         self.penalty = None
         self.average_jaccard = None
+        self._jaccard_sum = None
 
     @staticmethod
     def make_group_from_children(child1: 'AnomalyGroup', child2: 'AnomalyGroup', user_simi: UserSimilarity) -> 'AnomalyGroup':
@@ -43,9 +71,17 @@ class AnomalyGroup:
         OUTPUTS:
             group (AnomalyGroup) - AnomalyGroup object
         """
-        users = child1.users + child2.users
-        group_product_set_intersection = child1.group_product_set_intersection & child2.group_product_set_intersection
-        group_product_set_union = child1.group_product_set_union | child2.group_product_set_union
+        users = np.concatenate((child1.users, child2.users))
+        if child1.n_common_products_reviewed == 0 or child2.n_common_products_reviewed == 0:
+            # Intersecting with an empty set is empty, so share the empty bitset instead of computing it
+            group_product_set_intersection, n_common_products_reviewed = user_simi.get_empty_bitset(), 0
+        else:
+            group_product_set_intersection, n_common_products_reviewed = bitwise_and_count(
+                child1.group_product_set_intersection, child2.group_product_set_intersection)
+            if n_common_products_reviewed == 0:
+                group_product_set_intersection = user_simi.get_empty_bitset()
+        group_product_set_union, n_total_products_reviewed = bitwise_or_count(
+            child1.group_product_set_union, child2.group_product_set_union)
         n_total_reviews = child1.n_total_reviews + child2.n_total_reviews
 
         group = AnomalyGroup(
@@ -55,7 +91,9 @@ class AnomalyGroup:
             n_total_reviews=n_total_reviews,
             user_simi=user_simi,
             child1=child1,
-            child2=child2
+            child2=child2,
+            n_total_products_reviewed=n_total_products_reviewed,
+            n_common_products_reviewed=n_common_products_reviewed
         )
 
         return group
@@ -66,7 +104,8 @@ class AnomalyGroup:
         Makes an anomaly group object from many child anomaly groups.
         Internally uses make_group_from_children() to merge two groups at a time.
 
-        In recursive mode, this recursively merges two halves of the list of children until there is only one group left.
+        In recursive mode, this merges neighboring pairs of children in rounds until there is only one group left,
+        which builds a balanced merge tree without recursion.
         In iterative mode, this repeateadly takes two children and merges them into one until there is only one group left.
         Iterative mode also computes Jaccard Similarity for children now, while recursive will do it only when group_anomaly_compactness is called.
         Recursive is generally faster and is the default option.
@@ -79,30 +118,66 @@ class AnomalyGroup:
             group (AnomalyGroup) - AnomalyGroup object
         """
         if recursive:
-            return AnomalyGroup._make_group_from_many_children_recursive(children, user_simi)
+            return AnomalyGroup._make_group_from_many_children_pairwise(children, user_simi)
         
         while len(children) > 1:
             child1 = children.pop(0)
             child2 = children.pop(0)
             group = AnomalyGroup.make_group_from_children(child1, child2, user_simi)
-            group._average_jaccard() # compute average jaccard similarity, which is used by parent groups
+            group._jaccard_similarity_sum() # compute the jaccard similarity sum, which is used by parent groups
             children.append(group)
 
         return children[0]
 
     @staticmethod
-    def _make_group_from_many_children_recursive(children: list['AnomalyGroup'], user_simi: UserSimilarity) -> 'AnomalyGroup':
-        """ Helper function to make_group_from_many_children() """
+    def make_kary_group(children: list['AnomalyGroup'], user_simi: UserSimilarity) -> 'AnomalyGroup':
+        """
+        Makes an anomaly group object from many child anomaly groups in a single merge.
+        Unlike make_group_from_many_children, no intermediate groups are built.
+        The product sets of all children are reduced at once and the Jaccard sum crosses every pair of children directly.
+
+        INPUTS:
+            children (list[AnomalyGroup]) - list of AnomalyGroup objects
+            user_simi (UserSimilarity) - UserSimilarity object
+        
+        OUTPUTS:
+            group (AnomalyGroup) - AnomalyGroup object
+        """
         if len(children) == 1:
             return children[0]
-        elif len(children) == 2:
-            return AnomalyGroup.make_group_from_children(children[0], children[1], user_simi)
+
+        users = np.concatenate([child.users for child in children])
+        if any(child.n_common_products_reviewed == 0 for child in children):
+            # Intersecting with an empty set is empty, so share the empty bitset instead of computing it
+            group_product_set_intersection, n_common_products_reviewed = user_simi.get_empty_bitset(), 0
         else:
-            return AnomalyGroup.make_group_from_children(
-                AnomalyGroup._make_group_from_many_children_recursive(children[:len(children) // 2], user_simi),
-                AnomalyGroup._make_group_from_many_children_recursive(children[len(children) // 2:], user_simi),
-                user_simi
-            )        
+            group_product_set_intersection = np.bitwise_and.reduce([child.group_product_set_intersection for child in children])
+            n_common_products_reviewed = int(popcount(group_product_set_intersection))
+        group_product_set_union = np.bitwise_or.reduce([child.group_product_set_union for child in children])
+        n_total_reviews = sum(child.n_total_reviews for child in children)
+
+        group = AnomalyGroup(
+            users=users,
+            group_product_set_intersection=group_product_set_intersection,
+            group_product_set_union=group_product_set_union,
+            n_total_reviews=n_total_reviews,
+            user_simi=user_simi,
+            n_common_products_reviewed=n_common_products_reviewed,
+            children=children
+        )
+
+        return group
+
+    @staticmethod
+    def _make_group_from_many_children_pairwise(children: list['AnomalyGroup'], user_simi: UserSimilarity) -> 'AnomalyGroup':
+        """ Helper function to make_group_from_many_children() """
+        groups = list(children)
+        while len(groups) > 1:
+            merged = [AnomalyGroup.make_group_from_children(groups[i], groups[i + 1], user_simi) for i in range(0, len(groups) - 1, 2)]
+            if len(groups) % 2 == 1:
+                merged.append(groups[-1])
+            groups = merged
+        return groups[0]
      
     @staticmethod
     def make_single_user_group(user: int, user_simi: UserSimilarity) -> 'AnomalyGroup':
@@ -116,42 +191,82 @@ class AnomalyGroup:
         OUTPUTS:    
             group (AnomalyGroup) - AnomalyGroup object
         """
-        users = [user]
-        group_product_set_intersection = user_simi.get_user_bitarray(user)
-        group_product_set_union = user_simi.get_user_bitarray(user)
-        n_total_reviews = group_product_set_union.count()
+        users = np.array([user], dtype=np.int32)
+        # The intersection and union of a single user are both its item set, so both share one bitset.
+        # Bitsets are never modified in place, so this aliasing is safe.
+        bitset = user_simi.get_user_bitset(user)
+        n_total_reviews = int(popcount(bitset))
 
         group = AnomalyGroup(
             users=users,
-            group_product_set_intersection=group_product_set_intersection,
-            group_product_set_union=group_product_set_union,
+            group_product_set_intersection=bitset,
+            group_product_set_union=bitset,
             n_total_reviews=n_total_reviews,
-            user_simi=user_simi
+            user_simi=user_simi,
+            n_total_products_reviewed=n_total_reviews,
+            n_common_products_reviewed=n_total_reviews
         )
 
         return group
 
+
+    @staticmethod
+    def make_single_user_groups(users: np.ndarray, user_simi: UserSimilarity) -> list['AnomalyGroup']:
+        """
+        Makes a single user anomaly group for each user.
+        Same as calling make_single_user_group for each user, but the review counts of all users are looked up at once.
+
+        INPUTS:
+            users - the users to make groups for
+            user_simi (UserSimilarity) - UserSimilarity object
+
+        OUTPUTS:    
+            groups (list[AnomalyGroup]) - AnomalyGroup object for each user
+        """
+        users = np.asarray(users, dtype=np.int32)
+        n_reviews = user_simi.get_user_item_counts(users).tolist()
+        groups = []
+        for user, n_user_reviews in zip(users, n_reviews):
+            bitset = user_simi.get_user_bitset(user)
+            groups.append(AnomalyGroup(
+                users=np.array([user], dtype=np.int32),
+                group_product_set_intersection=bitset,
+                group_product_set_union=bitset,
+                n_total_reviews=n_user_reviews,
+                user_simi=user_simi,
+                n_total_products_reviewed=n_user_reviews,
+                n_common_products_reviewed=n_user_reviews
+            ))
+        return groups
     
     @staticmethod
-    def make_group(users: list, user_simi: UserSimilarity) -> 'AnomalyGroup':
+    def make_group(users: list | np.ndarray, user_simi: UserSimilarity) -> 'AnomalyGroup':
         """
         Makes an anomaly group object from a list of users.
 
         INPUTS:
-            users (list) - list of users in the group
+            users (list | np.ndarray) - list or array of users in the group, stored as an int32 array
             user_simi (UserSimilarity) - UserSimilarity object
 
         OUTPUTS:    
             group (AnomalyGroup) - AnomalyGroup object
         """
-        user_bitarrays = user_simi.get_user_bitarrays(users)
-        group_product_set_intersection = user_bitarrays[0]  
-        group_product_set_union = user_bitarrays[0]
-        n_total_reviews = user_bitarrays[0].count()
-        for i in range(1, len(user_bitarrays)):
-            group_product_set_intersection = group_product_set_intersection & user_bitarrays[i]
-            group_product_set_union = group_product_set_union | user_bitarrays[i]
-            n_total_reviews += user_bitarrays[i].count()
+        users = np.asarray(users, dtype=np.int32)
+        user_bitsets = user_simi.get_user_bitsets(users)
+        group_product_set_union = np.bitwise_or.reduce(user_bitsets, axis=0)
+        n_total_reviews = int(user_simi.get_user_item_counts(users).sum())
+
+        # The intersection is reduced a chunk of users at a time, and stops as soon as it is empty
+        group_product_set_intersection = user_simi.get_empty_bitset()
+        if len(users) > 0:
+            group_product_set_intersection = user_bitsets[0]
+            for start in range(1, len(users), MAKE_GROUP_CHUNK_USERS):
+                if not group_product_set_intersection.any():
+                    break
+                group_product_set_intersection = group_product_set_intersection & np.bitwise_and.reduce(
+                    user_bitsets[start:start + MAKE_GROUP_CHUNK_USERS], axis=0)
+            if not group_product_set_intersection.any():
+                group_product_set_intersection = user_simi.get_empty_bitset()
 
         group = AnomalyGroup(
             users=users,
@@ -175,9 +290,24 @@ class AnomalyGroup:
                            a smaller beta means the sigmoid function is more stretched, so larger groups are also penalized
                            and smaller groups are penalized even more.
         """
-        self.penalty = 1 / (1 + np.e**(-1 * (beta * (self.n_users + self.n_total_products_reviewed) - 3)))
+        self.penalty = 1 / (1 + math.exp(3 - beta * (self.n_users + self.n_total_products_reviewed)))
         return self.penalty
 
+    @staticmethod
+    def penalty_function_vec(n_users: np.ndarray, n_total_products_reviewed: np.ndarray, beta: float = 0.15) -> np.ndarray:
+        """
+        Vectorized version of _penalty_function for many groups at once.
+
+        INPUTS:
+            n_users (np.ndarray) - number of users in each group
+            n_total_products_reviewed (np.ndarray) - number of products reviewed by each group
+            beta (float) - hyperparameter for the penalty function
+
+        OUTPUTS:
+            L_g (np.ndarray) - penalty for each group
+        """
+        return expit(beta * (np.asarray(n_users) + np.asarray(n_total_products_reviewed)) - 3)
+
     def _review_tightness(self):
         """
         Generates review tightness for a group.
@@ -202,6 +332,34 @@ class AnomalyGroup:
         PT_g = self.n_common_products_reviewed / self.n_total_products_reviewed
         return PT_g
     
+    def _jaccard_similarity_sum(self):
+        """
+        Compute the sum of the Jaccard similarities over all ordered pairs of users in a group, including each user with itself.
+        The sum is memoized, so parents only add the cross similarities between their children.
+        A single user group has a sum of 1.
+
+        OUTPUTS:
+            jaccard_sum (float) - sum of jaccard similarities between all pairs of users
+        """
+        if self._jaccard_sum is not None:
+            return self._jaccard_sum
+
+        if self.n_users <= 1:
+            self._jaccard_sum = self.n_users
+        elif len(self.children) < 2:
+            self._jaccard_sum = self.user_simi.get_jaccard_similarity_sum(self.users, self.users)
+        else:
+            # Each pair of children is crossed once, by taking each child against the users of all later children
+            children_similarity_sum = 0
+            offset = 0
+            for child in self.children[:-1]:
+                offset += child.n_users
+                children_similarity_sum += self.user_simi.get_jaccard_similarity_sum(child.users, self.users[offset:])
+            self._jaccard_sum = 2 * children_similarity_sum
+            for child in self.children:
+                self._jaccard_sum += child._jaccard_similarity_sum()
+        return self._jaccard_sum
+
     def _average_jaccard(self):
         """
         Compute average Jaccard similarity between all pairs of users in a group.
@@ -213,23 +371,8 @@ class AnomalyGroup:
         if self.n_users <= 1:
             self.average_jaccard = 1
             return 1
-        
-        similarity_scores_children = [
-            self.user_simi.get_jaccard_similarity(i, j)
-            for i in self.child1.users
-            for j in self.child2.users
-        ]
-
-        if self.child1.average_jaccard is None:
-            self.child1._average_jaccard()
-        if self.child2.average_jaccard is None:
-            self.child2._average_jaccard()
 
-        child1_similarity_score_sum = self.child1.average_jaccard * self.child1.n_users**2
-        child2_similarity_score_sum = self.child2.average_jaccard * self.child2.n_users**2
-
-        self.average_jaccard = (2 * sum(similarity_scores_children) + child1_similarity_score_sum + child2_similarity_score_sum) / self.n_users**2
-        
+        self.average_jaccard = self._jaccard_similarity_sum() / (self.n_users * self.n_users)
         return self.average_jaccard
 
     def _neighbor_tightness(self):
@@ -258,6 +401,9 @@ class AnomalyGroup:
             self._penalty_function(beta=beta)
         else:
             self.penalty = 1
+        # Without common products the product tightness is 0, so skip the expensive neighbor tightness
+        if self.n_common_products_reviewed == 0:
+            return 0
         RT_g = self._review_tightness()
         PT_g = self._product_tightness()
         NT_g = self._neighbor_tightness()
@@ -269,6 +415,9 @@ class AnomalyGroup:
 
 class AnomalyScorer:
 
+    # Weights of the compactness, average rating deviation and burstness in the metadata anomaly score
+    METADATA_WEIGHTS = np.array([4/5, 1/10, 1/10])
+
     def __init__(self, dataset: BasicDataset, enable_penalty: bool, use_metadata: bool = True, burstness_threshold: int = 30, 
                  max_group_size: int = 5000, beta: float = 0.15):
         """
@@ -294,12 +443,13 @@ class AnomalyScorer:
         if use_metadata:
             self.avg_ratings = dataset.metadata_df.groupby(dataset.METADATA_ITEM_ID)[dataset.METADATA_STAR_RATING].mean()
             self.product_average_ratings = self.avg_ratings.values 
-            self.graph_u2i = dataset.graph_u2i.toarray()
-            self.rating_matrix = dataset.rated_graph_u2i.toarray()
-            self.average_ratings_matrix = np.tile(self.product_average_ratings, (dataset.n_users, 1))
-            self.diff_matrix = (self.rating_matrix - self.average_ratings_matrix) * self.graph_u2i
-            self.sum_of_diffs = np.sum(np.abs(self.diff_matrix), axis=1)
-            self.num_rated_products = np.sum(self.graph_u2i, axis=1)
+            # Rating differences are only computed for the reviews stored in the sparse graph
+            graph_u2i = dataset.graph_u2i.tocoo()
+            ratings = np.asarray(dataset.rated_graph_u2i[graph_u2i.row, graph_u2i.col]).ravel()
+            diffs = (ratings - self.product_average_ratings[graph_u2i.col]) * graph_u2i.data
+            self.diff_matrix = csr_matrix((diffs, (graph_u2i.row, graph_u2i.col)), shape=graph_u2i.shape)
+            self.sum_of_diffs = np.asarray(abs(self.diff_matrix).sum(axis=1)).ravel()
+            self.num_rated_products = np.asarray(dataset.graph_u2i.getnnz(axis=1))
             self.avrd = np.where(self.num_rated_products != 0, self.sum_of_diffs / self.num_rated_products, 0)
 
             self.first_date = dataset.metadata_df.groupby(dataset.METADATA_USER_ID)[dataset.METADATA_DATE].min()
@@ -307,16 +457,23 @@ class AnomalyScorer:
             self.review_periods = (self.last_date-self.first_date).dt.days
             self.burstness = np.where(self.review_periods < self.burstness_threshold, 1 - self.review_periods / self.burstness_threshold, 0)
 
+            # Logs of the normalized metadata scores of each user, -inf where the score is 0
+            with np.errstate(divide='ignore'):
+                self.log_avrd = np.log(self.avrd / 5) # divide by 5 to normalize (max 5 star rating difference)
+                self.log_burstness = np.log(self.burstness)
+
         else:
             self.avrd = None
             self.burstness = None
+            self.log_avrd = None
+            self.log_burstness = None
 
-    def get_anomaly_score(self, group: list | AnomalyGroup):
+    def get_anomaly_score(self, group: list | np.ndarray | AnomalyGroup):
         """
         Generates overall anomaly score for a group of users.
 
         INPUTS:
-            group: AnomalyGroup object
+            group: AnomalyGroup object, or list or array of users
 
         OUTPUTS:
             score (float): overall anomaly score for the group
@@ -324,55 +481,196 @@ class AnomalyScorer:
         if len(group) > self.max_group_size:
             return 0
 
-        if isinstance(group, list):
+        if not isinstance(group, AnomalyGroup):
             group = AnomalyGroup.make_group(group, self.user_simi) 
 
+        # Groups without common products have 0 compactness, which makes the overall score 0
+        if group.n_common_products_reviewed == 0:
+            return 0
+
         if self.use_metadata:
             group_mean_avrd = np.mean(self.avrd[group.users]) / 5 # divide by 5 to normalize (max 5 star rating difference)
             group_mean_burstness = np.mean(self.burstness[group.users])
             score = AnomalyScorer.weighted_geometric_mean(
                 np.array([group.group_anomaly_compactness(self.enable_penalty, self.beta), group_mean_avrd, group_mean_burstness]), 
-                np.array([4/5, 1/10, 1/10]))
+                AnomalyScorer.METADATA_WEIGHTS)
         else:
             score = group.group_anomaly_compactness(self.enable_penalty, self.beta)
         return score
 
+    def get_anomaly_scores(self, groups: list):
+        """
+        Generates overall anomaly scores for many groups of users at once.
+        Equivalent to calling get_anomaly_score on each group, but the penalty, tightness and metadata
+        terms are computed for all groups in a single vectorized pass.
+        Neighbor tightness reuses the average jaccard of child groups, so groups should be in creation order.
+
+        INPUTS:
+            groups: list of AnomalyGroup objects, or lists or arrays of users
+
+        OUTPUTS:
+            scores (np.ndarray): overall anomaly score for each group
+        """
+        groups = [group if isinstance(group, AnomalyGroup) else AnomalyGroup.make_group(group, self.user_simi) for group in groups]
+        n_users = np.array([group.n_users for group in groups])
+        n_total_products_reviewed = np.array([group.n_total_products_reviewed for group in groups])
+        n_common_products_reviewed = np.array([group.n_common_products_reviewed for group in groups])
+        n_total_reviews = np.array([group.n_total_reviews for group in groups])
+        # Groups without common products have 0 compactness and score, so only the rest are scored.
+        # Product intersections only shrink when groups merge, so these groups never have scored ancestors.
+        scored = (n_users <= self.max_group_size) & (n_common_products_reviewed > 0)
+
+        if self.enable_penalty:
+            penalty = AnomalyGroup.penalty_function_vec(n_users, n_total_products_reviewed, self.beta)
+        else:
+            penalty = np.ones(len(groups))
+
+        has_products = n_total_products_reviewed > 0
+        safe_n_total_products_reviewed = np.where(has_products, n_total_products_reviewed, 1)
+        RT = np.where(has_products, n_total_reviews / (n_users * safe_n_total_products_reviewed), 0)
+        PT = np.where(has_products, n_common_products_reviewed / safe_n_total_products_reviewed, 0)
+
+        # Neighbor tightness builds on the children of each group, so it is still computed group by group
+        # The neighbor tightness of a single user is always 1
+        NT = np.ones(len(groups))
+        for i in np.flatnonzero(scored & (n_users > 1)):
+            NT[i] = groups[i]._neighbor_tightness()
+
+        compactness = penalty * RT * PT * NT
+        scores = np.zeros(len(groups))
+        if self.use_metadata:
+            group_means = self._group_sums(np.stack((self.avrd, self.burstness), axis=1), groups)[scored] / n_users[scored, None]
+            group_mean_avrd = group_means[:, 0] / 5 # divide by 5 to normalize (max 5 star rating difference)
+            group_mean_burstness = group_means[:, 1]
+            scores[scored] = AnomalyScorer.weighted_geometric_mean_vec(
+                np.stack([compactness[scored], group_mean_avrd, group_mean_burstness], axis=1),
+                AnomalyScorer.METADATA_WEIGHTS)
+        else:
+            scores[scored] = compactness[scored]
+        return scores
+
+    def single_user_anomaly_scores(self, users: np.ndarray):
+        """
+        Generates the anomaly score of the single user group of each user in one vectorized pass.
+        A single user has review, product and neighbor tightness of 1 if they reviewed any product, and 0 otherwise,
+        so the compactness is just the penalty.
+
+        INPUTS:
+            users (np.ndarray): users to score
+
+        OUTPUTS:
+            scores (np.ndarray): anomaly score of each user's single user group
+        """
+        users = np.asarray(users)
+        n_products = self.user_simi.get_user_item_counts(users)
+
+        if _numba and self.max_group_size >= 1:
+            scores = np.empty(len(users))
+            if self.use_metadata:
+                log_avrd, log_burstness = self.log_avrd[users], self.log_burstness[users]
+            else:
+                log_avrd = log_burstness = np.empty(0)
+            _single_user_anomaly_scores_kernel(n_products, log_avrd, log_burstness, self.use_metadata,
+                                               self.enable_penalty, self.beta, AnomalyScorer.METADATA_WEIGHTS, scores)
+            return scores
+
+        scored = (n_products > 0) & (1 <= self.max_group_size)
+
+        if self.enable_penalty:
+            compactness = AnomalyGroup.penalty_function_vec(1, n_products[scored], self.beta)
+        else:
+            compactness = np.ones(np.count_nonzero(scored))
+
+        scores = np.zeros(len(users))
+        if self.use_metadata:
+            # The mean metadata score of a single user is the user's own score, so its precomputed log is used
+            scored_users = users[scored]
+            scores[scored] = AnomalyScorer.weighted_geometric_mean_of_logs(
+                np.stack([np.log(compactness), self.log_avrd[scored_users], self.log_burstness[scored_users]], axis=1),
+                AnomalyScorer.METADATA_WEIGHTS)
+        else:
+            scores[scored] = compactness
+        return scores
 
-    def hierarchical_anomaly_scores(self, linkage_matrix, group_mapping: dict = None):
+    @staticmethod
+    def _group_sums(values: np.ndarray, groups: list):
+        """
+        Computes the sum of the values of the users in each group.
+        For balanced trees, the users of all groups are gathered and reduced at once.
+        For deep trees, where gathering every group's users is quadratic, the sum of a group is instead
+        the sum of its children's sums. Children missing from groups, like single users, are summed directly.
+        Groups should be in creation order, so children come before their parents.
+
+        INPUTS:
+            values (np.ndarray) - array of shape (n_users, n_values) with the values of each user
+            groups (list) - list of AnomalyGroup objects
+
+        OUTPUTS:
+            sums (np.ndarray) - array of shape (n_groups, n_values) with the value sums of each group
+        """
+        sizes = np.array([group.n_users for group in groups], dtype=np.int64)
+        if len(groups) == 0 or np.any(sizes == 0):
+            return np.array([values[group.users].sum(axis=0) for group in groups]).reshape(len(groups), values.shape[1])
+
+        if sizes.sum() <= GROUP_SUMS_GATHER_FACTOR * len(groups):
+            users = np.concatenate([group.users for group in groups])
+            offsets = np.cumsum(sizes) - sizes
+            return np.add.reduceat(values[users], offsets, axis=0)
+
+        # Sums are kept as python lists, which are faster to add than small numpy arrays
+        value_lists = values.tolist()
+        sums = []
+        position = {}
+        for group in groups:
+            if not group.children:
+                group_sum = values[group.users].sum(axis=0).tolist()
+            else:
+                group_sum = [0.0] * values.shape[1]
+                for child in group.children:
+                    child_position = position.get(id(child))
+                    if child_position is not None:
+                        child_sum = sums[child_position]
+                    elif child.n_users == 1:
+                        child_sum = value_lists[child.users[0]]
+                    else:
+                        child_sum = values[child.users].sum(axis=0).tolist()
+                    group_sum = [total + value for total, value in zip(group_sum, child_sum)]
+            position[id(group)] = len(sums)
+            sums.append(group_sum)
+        return np.array(sums)
+
+    def hierarchical_anomaly_scores(self, linkage_matrix, group_mapping: np.ndarray | dict = None):
         """
         Generates anomaly scores for each group in the hierarchical clustering linkage matrix.
 
         INPUTS:
             linkage_matrix: linkage matrix from scipy hierarchical clustering
-            group_mapping: dictionary mapping indices in the linkage matrix to indices in the original dataset
+            group_mapping: array (or dictionary) mapping indices in the linkage matrix to indices in the original dataset
 
         OUTPUTS:
             groups: list of AnomalyGroup objects
             anomaly_scores: list of anomaly scores for each group in the linkage matrix
         """
         if group_mapping is None:
-            group_mapping = utils.IdentityMap()
-            n_users = self.dataset.n_users
+            users = np.arange(self.dataset.n_users, dtype=np.int32)
+        elif isinstance(group_mapping, dict):
+            users = np.array([group_mapping[i] for i in range(len(group_mapping))], dtype=np.int32)
         else:
-            n_users = len(group_mapping.keys())
+            users = np.asarray(group_mapping, dtype=np.int32)
+        n_users = len(users)
 
-        groups = []
+        groups = AnomalyGroup.make_single_user_groups(users, self.user_simi)
         anomaly_scores = np.zeros(n_users + len(linkage_matrix), dtype=float)
-
-        for i in range(n_users):
-            user = group_mapping[i]
-            group = AnomalyGroup.make_single_user_group(user, self.user_simi)
-            score = self.get_anomaly_score(group)
-            anomaly_scores[i] = score
-            groups.append(group)
+        anomaly_scores[:n_users] = self.single_user_anomaly_scores(users)
     
-        for i, row in enumerate(linkage_matrix):
+        for row in linkage_matrix:
             child1 = int(row[0])
             child2 = int(row[1])
             group = AnomalyGroup.make_group_from_children(groups[child1], groups[child2], self.user_simi)
-            score = self.get_anomaly_score(group)
-            anomaly_scores[i + n_users] = score
             groups.append(group)
+
+        # Groups are in creation order, so children are always scored before their parents
+        anomaly_scores[n_users:] = self.get_anomaly_scores(groups[n_users:])
             
         return groups, anomaly_scores
     
@@ -395,13 +693,12 @@ class AnomalyScorer:
         ngroups = len(parent_groups) + self.dataset.n_users
         groups = [None] * ngroups
         anomaly_scores = np.zeros(ngroups, dtype=float)
+        creation_order = []
 
         # Initialize single user groups
-        for user in range(self.dataset.n_users):
-            group = AnomalyGroup.make_single_user_group(user, self.user_simi)
-            score = self.get_anomaly_score(group)
-            anomaly_scores[user] = score
-            groups[user] = group
+        users = np.arange(self.dataset.n_users)
+        groups[:self.dataset.n_users] = AnomalyGroup.make_single_user_groups(users, self.user_simi)
+        anomaly_scores[:self.dataset.n_users] = self.single_user_anomaly_scores(users)
 
         # Iterate through parent groups
         for parent, group in parent_groups:
@@ -413,10 +710,12 @@ class AnomalyScorer:
                                 "We expect the condensed_tree_df to contain a row for each parent-child pair.\n" +
                                 "The parent column should not contain any values less than dataset.n_users. Parent at dataset.n_users is the root of all nodes.\n")
                 
-            group = AnomalyGroup.make_group_from_many_children(child_groups, self.user_simi)
-            score = self.get_anomaly_score(group)
-            anomaly_scores[parent] = score
+            group = AnomalyGroup.make_kary_group(child_groups, self.user_simi)
             groups[parent] = group
+            creation_order.append(parent)
+
+        # Children are always created before their parents, so score the groups in that order
+        anomaly_scores[creation_order] = self.get_anomaly_scores([groups[i] for i in creation_order])
 
         return groups, anomaly_scores
 
@@ -436,16 +735,29 @@ class AnomalyScorer:
             user_anomaly_scores (np.ndarray): An array of anomaly scores for each user
         """
         user_anomaly_scores = np.zeros(n_users)
-        for i, score in enumerate(anomaly_scores):
-            for user in clusters[i]:
-                if user_anomaly_scores[user] < score:
-                    user_anomaly_scores[user] = score
+        anomaly_scores = np.asarray(anomaly_scores, dtype=float)
+        sizes = np.fromiter((len(cluster) for cluster in clusters), dtype=np.int64, count=len(clusters))
+        ends = np.cumsum(sizes)
+
+        # Clusters are flattened into one array of users in chunks, so the memory stays bounded for deep trees
+        start = 0
+        while start < len(clusters):
+            offset = ends[start] - sizes[start]
+            end = max(start + 1, int(np.searchsorted(ends, offset + USERWISE_CHUNK_USERS, side='right')))
+            flat_users = np.concatenate([np.asarray(cluster, dtype=np.int64).ravel() for cluster in clusters[start:end]])
+            if _numba:
+                cluster_ptr = np.concatenate(([0], ends[start:end] - offset))
+                _userwise_anomaly_scores_kernel(flat_users, cluster_ptr, anomaly_scores[start:end], user_anomaly_scores)
+            else:
+                # fmax ignores nan scores, like the comparison in the compiled kernel
+                np.fmax.at(user_anomaly_scores, flat_users, np.repeat(anomaly_scores[start:end], sizes[start:end]))
+            start = end
         return user_anomaly_scores
     
     @staticmethod
     def filter_small_groups(clusters, anomaly_scores, min_group_size):
         """
-        Given a set a clusters and anomaly scores for each clusters, this returns a filtered version which only contains more users than min_group_size.
+        Given a set a clusters and anomaly scores for each clusters, this returns a filtered version which only contains clusters with at least min_group_size users.
 
         Arguments:
             clusters (list): A list of lists of users (indices) in each cluster.
@@ -456,13 +768,10 @@ class AnomalyScorer:
             filtered_clusters (list): A list of lists of users (indices) in each cluster.
             filtered_anomaly_scores (np.ndarray): An array of anomaly scores for each cluster.
         """
-        filtered_clusters = []
-        filtered_scores = []
-        for i, cluster in enumerate(clusters):
-            if len(cluster) < min_group_size:
-                filtered_clusters.append(cluster)
-                filtered_scores.append(anomaly_scores[i])
-        filtered_anomaly_scores = np.array(filtered_scores)
+        sizes = np.fromiter((len(cluster) for cluster in clusters), dtype=np.int64, count=len(clusters))
+        keep = sizes >= min_group_size
+        filtered_clusters = [clusters[i] for i in np.flatnonzero(keep)]
+        filtered_anomaly_scores = np.asarray(anomaly_scores)[keep]
         return filtered_clusters, filtered_anomaly_scores
 
     @staticmethod
@@ -474,6 +783,22 @@ class AnomalyScorer:
             return 0
         return np.exp(AnomalyScorer.weighted_arithmetic_mean(np.log(scores), weights))
 
+    @staticmethod
+    def weighted_geometric_mean_vec(scores: np.ndarray, weights: np.ndarray):
+        """
+        Computes the weighted geometric mean of each row of scores.
+        """
+        with np.errstate(divide='ignore'):
+            return AnomalyScorer.weighted_geometric_mean_of_logs(np.log(scores), weights)
+
+    @staticmethod
+    def weighted_geometric_mean_of_logs(log_scores: np.ndarray, weights: np.ndarray):
+        """
+        Computes the weighted geometric mean of each row of scores, given the logs of the scores.
+        A score of 0 has a log of -inf, which gives a mean of 0.
+        """
+        return np.exp(np.sum(log_scores * weights, axis=1) / np.sum(weights))
+
     @staticmethod
     def weighted_harmonic_mean(scores: np.ndarray, weights: np.ndarray):
         """
@@ -488,4 +813,34 @@ class AnomalyScorer:
         """
         Computes the weighted arithmetic mean of the scores.
         """
-        return np.sum(scores * weights) / np.sum(weights)
\ No newline at end of file
+        return np.sum(scores * weights) / np.sum(weights)
+
+if _numba:
+
+    @njit(cache=True)
+    def _userwise_anomaly_scores_kernel(flat_users, cluster_ptr, anomaly_scores, user_anomaly_scores):
+        """ Raises the score of each user to the highest anomaly score of any cluster it is in. """
+        for i in range(len(anomaly_scores)):
+            score = anomaly_scores[i]
+            for k in range(cluster_ptr[i], cluster_ptr[i + 1]):
+                user = flat_users[k]
+                if user_anomaly_scores[user] < score:
+                    user_anomaly_scores[user] = score
+
+    @njit(parallel=True, cache=True)
+    def _single_user_anomaly_scores_kernel(n_products, log_avrd, log_burstness, use_metadata, enable_penalty, beta, 
+                                           weights, scores):
+        """ Computes the anomaly score of each single user group in parallel, see single_user_anomaly_scores. """
+        total_weight = weights.sum()
+        for i in prange(len(n_products)):
+            if n_products[i] == 0:
+                scores[i] = 0.0
+                continue
+            compactness = 1.0
+            if enable_penalty:
+                compactness = 1 / (1 + math.exp(3 - beta * (1 + n_products[i])))
+            if use_metadata:
+                scores[i] = math.exp((weights[0] * math.log(compactness) + weights[1] * log_avrd[i]
+                                      + weights[2] * log_burstness[i]) / total_weight)
+            else:
+                scores[i] = compactness
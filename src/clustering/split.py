@@ -1,5 +1,5 @@
 import numpy as np
-from sklearn.cluster import KMeans
+from sklearn.cluster import MiniBatchKMeans
 import math
 
 def split_matrix_random(matrix, max_group_size = 0, num_groups = 0):
@@ -61,16 +61,18 @@ def split_matrix_kmeans(matrix, num_groups = 0, max_group_size = 0, trials = 10)
         groups (list) - list of group matrices
         group_indices (list) - list of indices of the rows in the original matrix that are in each group 
     """
-    def _split_matrix_kmeans(matrix, num_groups):
-        kmeans = KMeans(n_clusters=num_groups, n_init="auto").fit(matrix)
-        labels = kmeans.labels_
-
-        groups = []
-        group_indices = []
-        for i in range(num_groups):
-            group_indices.append(np.where(labels == i)[0])
-            group = matrix[group_indices[i]]
-            groups.append(group)
+    def _kmeans_labels(matrix, num_groups):
+        # A single mini-batch k-means init is enough, since any split that fits max_group_size is accepted
+        kmeans = MiniBatchKMeans(n_clusters=num_groups, batch_size=min(4096, matrix.shape[0]), n_init=1, max_iter=100)
+        return kmeans.fit(matrix).labels_
+
+    def _split_matrix_by_labels(matrix, labels, sizes):
+        # A stable sort by label lays out the rows of each group contiguously, in their original order
+        order = np.argsort(labels, kind="stable")
+        edges = np.concatenate(([0], np.cumsum(sizes)))
+        # Mini-batch k-means can leave clusters empty, these do not become groups
+        group_indices = [order[edges[i]:edges[i + 1]] for i in np.flatnonzero(sizes)]
+        groups = [matrix[indices] for indices in group_indices]
 
         return groups, group_indices
     
@@ -78,8 +80,11 @@ def split_matrix_kmeans(matrix, num_groups = 0, max_group_size = 0, trials = 10)
         num_groups = math.ceil(matrix.shape[0] / max_group_size)
 
     for i in range(trials):
-        groups, group_indices = _split_matrix_kmeans(matrix, num_groups+i)
-        if max([len(group) for group in groups]) <= max_group_size:
+        labels = _kmeans_labels(matrix, num_groups+i)
+        sizes = np.bincount(labels, minlength=num_groups+i)
+        # Only build the groups once the cluster sizes fit
+        if sizes.max() <= max_group_size:
+            groups, group_indices = _split_matrix_by_labels(matrix, labels, sizes)
             break
     else:
         groups, group_indices = split_matrix_random(matrix, max_group_size = max_group_size)
@@ -89,15 +94,15 @@ def split_matrix_kmeans(matrix, num_groups = 0, max_group_size = 0, trials = 10)
 
 def build_group_mapping(group, indices):
     """ Builds a mapping from index of a user in a group to the indices of the rows in the original matrix that are in the group.
-        Returns a dictionary.
+        The keys are just the positions 0..len(group)-1, so the mapping is a numpy array indexed by them.
     """
-    group_mapping = {i: indices[i] for i in range(len(group))}
+    group_mapping = np.asarray(indices)[:len(group)]
     return group_mapping
 
 def build_group_split_mappings(groups, group_indices):
     """ Builds all mappings for a group split.
         Mappings are from index of a user in a group to the indices of the rows in the original matrix that are in the group.
-        Returns a list of dictionaries.
+        Returns a list of numpy arrays.
     """
     group_mappings = []
     for i in range(len(groups)):
@@ -122,7 +127,7 @@ def merge_splits_after_clustering(groups, group_indices, clusters):
     all_clusters = []
     for group in range(len(clusters)):
         for cluster in clusters[group]:
-            all_clusters.append([group_mappings[group][user] for user in cluster])
+            all_clusters.append(group_mappings[group][np.asarray(cluster, dtype=int)].tolist())
 
     return all_clusters
 
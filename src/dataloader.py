@@ -138,7 +138,8 @@ class GraphUser2ItemDataset(BasicDataset):
 
     def __init__(self, graph_u2i: scipy.sparse.csr_matrix, user_labels: np.array):
         self._graph_u2i = graph_u2i
-        self._graph_u2u = self._graph_u2i @ self._graph_u2i.T
+        self._graph_u2u = (self._graph_u2i @ self._graph_u2i.T).tocsr()
+        self._graph_u2u.sort_indices() # samplers binary search the positive users of each row
         self._labels = user_labels
         self._n_users, self._m_items = self._graph_u2i.shape
         if len(self._labels) != self._n_users:
@@ -17,6 +17,7 @@ class LightGCNTrainingConfig:
     weight_decay: float = 1e-4
     n_pos_samples: int = 10
     n_neg_samples: int = 10
+    mixed_precision: bool = False # bf16 autocast of the forward pass and loss, only used on GPU
 
     # If pretrained, set True and pass pretrained embeddings
     pretrained: bool = False
@@ -1,5 +1,7 @@
 import numpy as np
 import torch
+from concurrent.futures import ThreadPoolExecutor
+from time import time
 
 from src.dataloader import BasicDataset
 from src.similarity import UserSimilarity
@@ -11,11 +13,35 @@ class ModelLoss:
     def __init__(self, device: torch.device, dataset: BasicDataset):
         self.device = device
         self.dataset = dataset
-        pass
+        self._pinned_buffer = None # pinned host buffer for copying arrays to the device
+        self._pinned_buffer_copied = None # cuda event recorded after the last copy out of the pinned buffer
 
     def get_loss(self):
         pass
 
+    def close(self):
+        """ Releases background resources held by the loss. Should be called once training is over. """
+        pass
+
+    def _to_device(self, array: np.ndarray):
+        """ Copies a numpy array to the device.
+            For CUDA devices, the array is staged in a reusable pinned buffer so the copy can be asynchronous.
+        """
+        tensor = torch.from_numpy(array)
+        if self.device.type != "cuda":
+            return tensor.to(self.device)
+        if (self._pinned_buffer is None or self._pinned_buffer.dtype != tensor.dtype 
+                or self._pinned_buffer.numel() < tensor.numel()):
+            self._pinned_buffer = torch.empty(tensor.numel(), dtype=tensor.dtype, pin_memory=True)
+        if self._pinned_buffer_copied is not None:
+            self._pinned_buffer_copied.synchronize() # do not overwrite the buffer while it is still being copied
+        staged = self._pinned_buffer[:tensor.numel()].view(tensor.shape)
+        staged.copy_(tensor)
+        device_tensor = staged.to(self.device, non_blocking=True)
+        self._pinned_buffer_copied = torch.cuda.Event()
+        self._pinned_buffer_copied.record()
+        return device_tensor
+
 class SimilarityLoss(ModelLoss):
     """The similarity loss from DeepFD will be applied to LightGCN for embeddings.
        Similarities are only computed between each node and its samples to avoid computing all pairwise similarities.
@@ -25,61 +51,113 @@ class SimilarityLoss(ModelLoss):
         Therefore, we assume that the a sample of all nodes is a sample of mostly negative nodes.
         We also allow duplicate negative nodes. 
         This means that some negative nodes will actually be positive nodes, so it may be good to increase n_neg.
+
+        When gpu_sampling is True and the device is a GPU, fast sampling is done on the GPU.
+        This keeps a copy of the user-user graph on the GPU, so it is off by default.
+
+        When prefetch is True, prefetch_epoch samples the next epoch and computes its similarities in a background thread,
+        so this CPU work overlaps with training. close must be called after training to stop the background thread.
     """
 
-    def __init__(self, device: torch.device, dataset: BasicDataset, n_pos: int, n_neg: int, fast_sampling: bool = False):
+    def __init__(self, device: torch.device, dataset: BasicDataset, n_pos: int, n_neg: int, fast_sampling: bool = False, 
+                 gpu_sampling: bool = False, prefetch: bool = True):
         super().__init__(device, dataset)
         self.user_simi = UserSimilarity(dataset.graph_u2i)
         if fast_sampling:
-            self.n_pos, self.n_neg = sampling.get_adjusted_npos_nneg_for_fast_sampling(self.user_simi, n_pos, n_neg)
+            self.n_pos, self.n_neg = sampling.get_adjusted_npos_nneg_for_fast_sampling(self.user_simi, n_pos, n_neg, 
+                                                                                       dataset.graph_u2u)
         else:
             self.n_pos = n_pos
             self.n_neg = n_neg
         self.fast_sampling = fast_sampling
+        self.gpu_sampling = gpu_sampling
+        self._sampling_executor = ThreadPoolExecutor(max_workers=1) if prefetch else None
+        self._prefetched_epoch = None # future of the samples and similarities for the next epoch
+        self.sampling_time = 0. # seconds spent sampling and computing similarities for the last epoch, even in the background
 
-    def get_loss(self, user_nodes, user_embs, samples):
+    def get_loss(self, user_nodes, user_embs, samples, sample_simi):
         """ 
         Arguments:
             user_nodes: list of user node indices in this batch
             user_embs: tensor of all user embeddings
-            samples: 2D numpy array of pos/neg samples of each node
+            samples: 2D numpy array of pos/neg samples of each node in this batch, aligned with user_nodes
                 samples should be generated once per epoch by sample_train_set_pos_neg_users
+            sample_simi: tensor of graph similarities between each node in this batch and its samples on the device
+                sample_simi should be computed once per epoch by get_sample_similarities
         """
         # Get user embeddings
         user_embs_selected = user_embs[user_nodes]
 
         # Get sample embeddings for each user in this batch
-        selected_samples = samples[user_nodes]
-        sample_embs = user_embs[selected_samples.flatten()].view(*selected_samples.shape, -1)
+        sample_embs = user_embs[samples.flatten()].view(*samples.shape, -1)
         
         # Compute similarities between each user embedding and its samples embeddings
         dis_ij = (user_embs_selected[:, None, :] - sample_embs) ** 2
         simi_embs = torch.exp(-dis_ij.sum(dim=-1))
 
-        # Calculate similarity from graph
-        simi_feat_list = []
-        for node_i in user_nodes:
-            for sample_index in range(samples.shape[1]):
-                node_j = samples[node_i, sample_index]
-                simi_feat_list.append(self.user_simi.get_smoothed_jaccard_similarity(node_i, node_j))
-        simi_feat = torch.FloatTensor(simi_feat_list).view(len(user_nodes), -1).to(self.device)
-
         # Compute loss
-        L = simi_feat * ((simi_embs - simi_feat) ** 2)
+        L = sample_simi * ((simi_embs - sample_simi) ** 2)
         return L.mean()
 
-    def sample_train_set_pos_neg_users(self):
-        return sampling.sample_train_set_pos_neg_users(self.dataset, self.n_pos, self.n_neg, self.fast_sampling)
+    def get_sample_similarities(self, samples):
+        """ Computes the graph similarity between every user node and each of its samples.
+            Returns a tensor on the device with the same shape as samples.
+            Samples are fixed for an epoch, so this is done once per epoch and get_loss only gathers from the result.
+        """
+        return self._to_device(self._get_sample_similarities_array(samples)).view(*samples.shape)
+
+    def _get_sample_similarities_array(self, samples):
+        """ Computes the graph similarities of get_sample_similarities as a flat numpy array on the CPU. """
+        nodes_i = np.repeat(np.arange(len(samples)), samples.shape[1])
+        return self.user_simi.get_smoothed_jaccard_similarities(nodes_i, samples.ravel())
+
+    def _sample_epoch_arrays(self, rng=None):
+        """ Samples the nodes of an epoch and computes their similarities as numpy arrays.
+            Also returns the seconds this took, since it may run in the background thread.
+        """
+        start = time()
+        samples = sampling.sample_train_set_pos_neg_users(self.dataset, self.n_pos, self.n_neg, self.fast_sampling, rng, 
+                                                          device=self.device if self.gpu_sampling else None)
+        simi_feat_array = self._get_sample_similarities_array(samples)
+        return samples, simi_feat_array, time() - start
+
+    def sample_epoch(self):
+        """ Returns the samples of this epoch and the tensor of their similarities on the device.
+            If they were prefetched, waits for the background thread to finish.
+            sampling_time is set to the time spent sampling them, wherever that happened.
+        """
+        if self._prefetched_epoch is not None:
+            samples, simi_feat_array, self.sampling_time = self._prefetched_epoch.result()
+            self._prefetched_epoch = None
+        else:
+            samples, simi_feat_array, self.sampling_time = self._sample_epoch_arrays()
+        return samples, self._to_device(simi_feat_array).view(*samples.shape)
+
+    def prefetch_epoch(self):
+        """ Starts sampling the next epoch and computing its similarities in a background thread, if prefetching is enabled.
+            The seed is drawn from numpy's global generator here, so prefetched samples are still reproducible.
+        """
+        if self._sampling_executor is None:
+            return
+        rng = np.random.RandomState(np.random.randint(0, 2**31))
+        self._prefetched_epoch = self._sampling_executor.submit(self._sample_epoch_arrays, rng)
+
+    def close(self):
+        """ Cancels any prefetched epoch and shuts down the background sampling thread. """
+        if self._prefetched_epoch is not None:
+            self._prefetched_epoch.cancel()
+            self._prefetched_epoch = None
+        if self._sampling_executor is not None:
+            self._sampling_executor.shutdown(wait=True, cancel_futures=True)
+            self._sampling_executor = None
 
     @staticmethod
     def extend_user_node_batch(user_nodes, samples):
         """ Extends the batch of user nodes with their samples.
+            samples holds the samples of the nodes in this batch, aligned with user_nodes.
+            Returns the sorted unique nodes of the extended batch.
         """
-        extended_nodes_batch = set(user_nodes)
-        for node_i in user_nodes:
-            extended_nodes_batch |= set(samples[node_i])
-        
-        return np.array(list(extended_nodes_batch))
+        return np.unique(np.concatenate((np.asarray(user_nodes), samples.ravel())))
     
 class BPRLoss(ModelLoss):
 
@@ -94,15 +172,14 @@ class BPRLoss(ModelLoss):
         return loss
 
     def bpr_loss(self, users_emb, pos_emb, neg_emb, users_emb_ego, pos_emb_ego, neg_emb_ego):
-        reg_loss = (1/2)*(users_emb_ego.norm(2).pow(2) + 
-                         pos_emb_ego.norm(2).pow(2)  +
-                         neg_emb_ego.norm(2).pow(2))/float(len(users_emb))
-        pos_scores = torch.mul(users_emb, pos_emb)
-        pos_scores = torch.sum(pos_scores, dim=1)
-        neg_scores = torch.mul(users_emb, neg_emb)
-        neg_scores = torch.sum(neg_scores, dim=1)
-
-        loss = torch.mean(torch.nn.functional.softplus(neg_scores - pos_scores))
+        reg_loss = (1/2)*(users_emb_ego.pow(2).sum() + 
+                         pos_emb_ego.pow(2).sum() +
+                         neg_emb_ego.pow(2).sum())/float(len(users_emb))
+        pos_scores = torch.einsum('bd,bd->b', users_emb, pos_emb)
+        neg_scores = torch.einsum('bd,bd->b', users_emb, neg_emb)
+
+        # softplus(neg - pos) == -logsigmoid(pos - neg)
+        loss = -torch.mean(torch.nn.functional.logsigmoid(pos_scores - neg_scores))
         
         return loss, reg_loss
     
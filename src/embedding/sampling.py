@@ -1,5 +1,7 @@
 import logging
 import numpy as np
+import torch
+from typing import NamedTuple
 from src.similarity import UserSimilarity
 
 from src.dataloader import BasicDataset
@@ -10,11 +12,28 @@ try:
     path = join(dirname(__file__), "sources/sampling.cpp")
     _sampling = imp_from_filepath(path)
     _sample_ext = True
-except:
-    logging.getLogger("Logger").info("cpp sampling extension not loaded")
+except ImportError as e:
+    logging.getLogger("Logger").info(f"cpp sampling extension not loaded ({e}), BPR sampling will use python")
     _sample_ext = False
+except Exception as e:
+    # The extension exists but failed to build or load, so warn instead of silently falling back to python
+    logging.getLogger("Logger").warning(f"cpp sampling extension failed to load ({e!r}), BPR sampling will use python")
+    _sample_ext = False
+
+try:
+    from numba import njit, prange
+    _numba = True
+except ImportError:
+    logging.getLogger("Logger").info("numba not installed, sampling will not be compiled")
+    _numba = False
 
 
+def index_dtype(n: int):
+    """ Returns the smallest integer dtype of np.int32 and np.int64 which can index n nodes or items.
+        Samples are stored with this dtype, which halves their memory traffic for any realistic dataset.
+    """
+    return np.int32 if n <= np.iinfo(np.int32).max else np.int64
+
 def set_sampling_seed(seed):
     np.random.seed(seed)
     if _sample_ext:
@@ -30,21 +49,31 @@ def prob_neg_sample(user_simi: UserSimilarity, sample_size: int = "auto"):
     if sample_size == "auto":
         sample_size = n_users // 10
 
-    neg_samples = 0
-
-    rand_users = np.random.randint(n_users, size=sample_size, dtype=int)
-    rand_samples = np.random.randint(n_users, size=sample_size, dtype=int)
-    for i in range(sample_size):
-        if user_simi.items_in_common(rand_users[i], rand_samples[i]) == 0:
-            neg_samples += 1
+    rand_users = np.random.randint(n_users, size=sample_size, dtype=index_dtype(n_users))
+    rand_samples = np.random.randint(n_users, size=sample_size, dtype=index_dtype(n_users))
+    neg_samples = np.count_nonzero(user_simi.items_in_common_pairs(rand_users, rand_samples) == 0)
 
     return neg_samples / sample_size
 
-def get_adjusted_npos_nneg_for_fast_sampling(user_simi: UserSimilarity, n_pos: int, n_neg: int):
+def exact_prob_neg_sample(graph_u2u):
+    """
+    Computes the exact probability that two users drawn at random from the dataset share no items in common.
+    graph_u2u is u2i @ u2i.T, so it has a nonzero entry for every ordered pair of users sharing an item, 
+    including each user with themselves. Counting them replaces the sampling of prob_neg_sample.
+    """
+    n_users = graph_u2u.shape[0]
+    return 1 - np.count_nonzero(graph_u2u.data) / n_users**2
+
+def get_adjusted_npos_nneg_for_fast_sampling(user_simi: UserSimilarity, n_pos: int, n_neg: int, graph_u2u = None):
     """
     Adjusts the values of n_pos and n_neg so the same ratio of positive to negative samples is maintained when fast sampling is enabled.
+    If the user to user graph is given, the probability of a negative sample is computed exactly from it. 
+    Otherwise, it is estimated by prob_neg_sample.
     """
-    neg_prob = prob_neg_sample(user_simi)
+    if graph_u2u is not None:
+        neg_prob = exact_prob_neg_sample(graph_u2u)
+    else:
+        neg_prob = prob_neg_sample(user_simi)
     n_neg_adjusted = n_neg / neg_prob
     total = n_pos + n_neg
     total_adjusted = n_pos + n_neg_adjusted
@@ -52,7 +81,8 @@ def get_adjusted_npos_nneg_for_fast_sampling(user_simi: UserSimilarity, n_pos: i
     n_pos_adjusted = total - n_neg_adjusted 
     return n_pos_adjusted, n_neg_adjusted
 
-def sample_train_set_pos_neg_users(dataset: BasicDataset, n_pos: int, n_neg: int, fast: bool = False):
+def sample_train_set_pos_neg_users(dataset: BasicDataset, n_pos: int, n_neg: int, fast: bool = False, rng: np.random.RandomState = None,
+                                   device: torch.device = None):
     """ For each user node in the dataset, this samples n_pos positive nodes and n_neg negative nodes.
         A positive node shares an item and a negative node does not share an item.
         This returns a 2D numpy array of shape (n_users, n_pos+n_neg) with the indices of samples for each user node.
@@ -63,99 +93,442 @@ def sample_train_set_pos_neg_users(dataset: BasicDataset, n_pos: int, n_neg: int
         Therefore, we assume that the a sample of all nodes is a sample of mostly negative nodes.
         We also allow duplicate negative nodes. 
         This means that some negative nodes will actually be positive nodes, so it may be good to increase n_neg.
+
+        rng is the random generator to sample with. By default, numpy's global generator is used.
+        Pass a seeded np.random.RandomState to sample reproducibly from another thread.
+
+        When fast is True and a CUDA device is passed, the samples are drawn on the GPU with torch and copied back.
+        This keeps a copy of graph_u2u on the GPU, so it is only done when a device is passed.
     """
+    if rng is None:
+        rng = np.random
+    if fast and device is not None and torch.device(device).type == "cuda":
+        return _sample_train_set_pos_neg_users_torch(dataset, n_pos, n_neg, rng, device)
     if fast:
-        return _sample_train_set_pos_neg_users_fast(dataset, n_pos, n_neg)
-    return _sample_train_set_pos_neg_users_normal(dataset, n_pos, n_neg)
+        # Fast sampling is a few vectorized calls, which beat the compiled kernel and its per-user seeding
+        return _sample_train_set_pos_neg_users_fast(dataset, n_pos, n_neg, rng)
+    if _numba:
+        return _sample_train_set_pos_neg_users_compiled(dataset, n_pos, n_neg, rng)
+    return _sample_train_set_pos_neg_users_normal(dataset, n_pos, n_neg, rng)
 
-def _sample_train_set_pos_neg_users_normal(dataset, n_pos, n_neg):
+def _sample_train_set_pos_neg_users_normal(dataset, n_pos, n_neg, rng):
     g_u2u = dataset.graph_u2u 
-    samples = np.zeros((dataset.n_users, n_pos + n_neg), dtype=int)
-    all_indices = np.arange(dataset.n_users)
+    assert g_u2u.format == "csr", "positive pools are read directly from the CSR index arrays"
+    indptr, indices = g_u2u.indptr, g_u2u.indices
+    samples = np.zeros((dataset.n_users, n_pos + n_neg), dtype=index_dtype(dataset.n_users))
+    is_pos = np.zeros(dataset.n_users, dtype=bool)  # reusable mask of the positive nodes of the current user
+    _sample_positives(indptr, indices, dataset.n_users, samples[:, :n_pos], rng)
         
     for i in range(dataset.n_users):
-        pos_pool = g_u2u[i].nonzero()[1]                # indices of all positive nodes for user i
-
-        neg_pool = np.setdiff1d(all_indices, pos_pool)  # indices of all negative nodes for user i
+        pos_pool = indices[indptr[i]:indptr[i + 1]]   # indices of all positive nodes for user i
+        n_neg_pool = dataset.n_users - len(pos_pool)  # number of negative nodes for user i
 
-        if len(pos_pool) >= n_pos:
-            samples[i, :n_pos] = np.random.choice(pos_pool, n_pos, replace=False)
-        else:
-            samples[i, :len(pos_pool)] = pos_pool
-            samples[i, len(pos_pool):n_pos] = np.random.choice(all_indices, n_pos - len(pos_pool), replace=False)
-            
-        if len(neg_pool) >= n_neg:
-            samples[i, n_pos:] = np.random.choice(neg_pool, n_neg, replace=False)
+        is_pos[pos_pool] = True
+        if n_neg_pool >= max(2 * n_neg, dataset.n_users // 2):
+            # Most nodes are negative, so draw random nodes and reject the positives instead of building the pool
+            samples[i, n_pos:] = _rejection_sample_negatives(is_pos, n_neg, rng)
+        elif n_neg_pool >= n_neg:
+            neg_pool = np.flatnonzero(~is_pos)  # indices of all negative nodes for user i
+            samples[i, n_pos:] = rng.choice(neg_pool, n_neg, replace=False)
         else:
+            neg_pool = np.flatnonzero(~is_pos)
             samples[i, n_pos:n_pos + len(neg_pool)] = neg_pool
-            samples[i, n_pos+len(neg_pool):] = np.random.choice(all_indices, n_neg - len(neg_pool), replace=False)
+            samples[i, n_pos+len(neg_pool):] = rng.choice(dataset.n_users, n_neg - len(neg_pool), replace=False)
+        is_pos[pos_pool] = False  # toggle the mask back instead of clearing it
 
     return samples
 
-def _sample_train_set_pos_neg_users_fast(dataset, n_pos, n_neg):
+def _sample_positives(indptr, indices, n_users, pos_samples, rng):
+    """ Fills each row of pos_samples with distinct random positive nodes of that user.
+        Users with fewer positives than columns get all of their positives, followed by distinct random nodes.
+        Users with at least twice as many positives as columns draw distinct random offsets into their pool,
+        so only the chosen positives are read from the CSR indices.
+        The other users copy their small pools and sample them with a partial Fisher-Yates shuffle,
+        which draws the random numbers of every user in a single call per column.
+    """
+    n_pos = pos_samples.shape[1]
+    starts = indptr[:-1]
+    pool_sizes = np.diff(indptr)
+
+    large_users = np.flatnonzero(pool_sizes >= 2 * n_pos)
+    offsets = _random_distinct_offsets(pool_sizes[large_users], n_pos, rng)
+    pos_samples[large_users] = indices[starts[large_users, None] + offsets]
+
+    small_users = np.flatnonzero(pool_sizes < 2 * n_pos)
+    small_sizes = pool_sizes[small_users]
+    small_starts = np.cumsum(small_sizes) - small_sizes  # start of each pool in the copied pools
+    pools = indices[np.repeat(starts[small_users] - small_starts, small_sizes) + np.arange(small_sizes.sum())]
+    random_fractions = rng.random_sample((n_pos, len(small_users)))
+
+    for j in range(n_pos):
+        users = np.flatnonzero(small_sizes > j)
+        swap_from = small_starts[users] + j
+        swap_to = swap_from + (random_fractions[j, users] * (small_sizes[users] - j)).astype(swap_from.dtype)
+        pools[swap_from], pools[swap_to] = pools[swap_to], pools[swap_from]
+
+    columns = np.arange(n_pos)
+    has_pos = columns < small_sizes[:, None]
+    small_samples = np.empty((len(small_users), n_pos), dtype=pos_samples.dtype)
+    small_samples[has_pos] = pools[(small_starts[:, None] + columns)[has_pos]]
+
+    # Fill the missing positives with random nodes
+    short = np.flatnonzero(small_sizes < n_pos)
+    if len(short) > 0:
+        fill = _random_distinct_rows(small_sizes[short], n_pos, n_users, rng)
+        small_samples[short] = np.where(has_pos[short], small_samples[short], fill)
+    pos_samples[small_users] = small_samples
+
+def _random_distinct_offsets(sizes, k, rng, first_columns=None):
+    """ Draws a (len(sizes), k) matrix of random offsets, where the offsets of row i are distinct and below sizes[i].
+        When first_columns is passed, row i is only drawn from column first_columns[i] on and is -1 before it.
+        The offsets are drawn one column at a time for all rows at once,
+        and only the rows which repeated an offset of an earlier column are redrawn.
+    """
+    if first_columns is None:
+        first_columns = np.zeros(len(sizes), dtype=np.int64)
+    if np.any(k - first_columns > sizes):
+        raise ValueError("Cannot take a larger sample than population when 'replace=False'")
+    offsets = np.full((len(sizes), k), -1, dtype=np.int64)
+    for j in range(k):
+        rows = np.flatnonzero(first_columns <= j)
+        offsets[rows, j] = rng.random_sample(len(rows)) * sizes[rows]
+        repeated = rows[np.any(offsets[rows, :j] == offsets[rows, j, None], axis=1)]
+        while len(repeated) > 0:
+            offsets[repeated, j] = rng.random_sample(len(repeated)) * sizes[repeated]
+            repeated = repeated[np.any(offsets[repeated, :j] == offsets[repeated, j, None], axis=1)]
+    return offsets
+
+def _random_distinct_rows(first_columns, k, n_users, rng):
+    """ Draws a (len(first_columns), k) matrix of random nodes,
+        where row i is filled with distinct nodes from column first_columns[i] on and is -1 before it.
+    """
+    return _random_distinct_offsets(np.full(len(first_columns), n_users), k, rng, first_columns)
+
+def _rejection_sample_negatives(is_pos, n_neg, rng):
+    """ Samples n_neg distinct nodes which are not marked in the is_pos mask.
+        Random nodes are drawn in batches and positives are rejected until enough distinct negatives are found.
+        This is efficient when the large majority of nodes are negative.
+    """
+    negatives = np.empty(0, dtype=int)
+    while len(negatives) < n_neg:
+        candidates = rng.randint(0, len(is_pos), size=2 * n_neg)
+        negatives = np.concatenate((negatives, candidates[~is_pos[candidates]]))
+        # Remove duplicates while keeping the order the nodes were drawn in
+        _, first_occurrences = np.unique(negatives, return_index=True)
+        negatives = negatives[np.sort(first_occurrences)]
+    return negatives[:n_neg]
+
+def _sample_train_set_pos_neg_users_fast(dataset, n_pos, n_neg, rng):
     g_u2u = dataset.graph_u2u 
-    samples = np.zeros((dataset.n_users, n_pos + n_neg), dtype=int)
-    all_indices = np.arange(dataset.n_users)
+    assert g_u2u.format == "csr", "positive pools are read directly from the CSR index arrays"
+    indptr, indices = g_u2u.indptr, g_u2u.indices
+    samples = np.zeros((dataset.n_users, n_pos + n_neg), dtype=index_dtype(dataset.n_users))
+    _sample_positives(indptr, indices, dataset.n_users, samples[:, :n_pos], rng)
         
-    for i in range(dataset.n_users):
-        pos_pool = g_u2u[i].nonzero()[1]  # indices of all positive nodes for user i
+    # Here we make the simplifying assumption that the majority of nodes with be negatives.
+    # Therefore, sampling from all nodes wil give us mostly negatives and is good enough.
+    # We also sample with replacement for additional speed, even though this may give us some duplicates.
+    # This lets the negatives of all users be drawn in a single call.
+    samples[:, n_pos:] = rng.randint(0, dataset.n_users, size=(dataset.n_users, n_neg))
 
-        if len(pos_pool) >= n_pos:
-            samples[i, :n_pos] = np.random.choice(pos_pool, n_pos, replace=False)
-        else:
-            samples[i, :len(pos_pool)] = pos_pool
-            samples[i, len(pos_pool):n_pos] = np.random.choice(all_indices, n_pos - len(pos_pool), replace=False)
-                
-        # Here we make the simplifying assumption that the majority of nodes with be negatives.
-        # Therefore, sampling from all nodes wil give us mostly negatives and is good enough.
-        # We also sample with replacement for additional speed, even though this may give us some duplicates.
-        samples[i, n_pos:] = np.random.choice(all_indices, n_neg, replace=True)
+    return samples
+
+def _sample_train_set_pos_neg_users_torch(dataset, n_pos, n_neg, rng, device):
+    """ Same sampling as the fast python implementation, run with torch on the device.
+        Positives are drawn like in _sample_positives, with distinct random offsets into the large pools
+        and a partial Fisher-Yates shuffle of copies of the small pools.
+        Unlike the CPU samplers, the random nodes filling missing positives may repeat.
+    """
+    indptr, indices = _get_device_graph_u2u(dataset, device)
+    n_users = dataset.n_users
+    generator = torch.Generator(device=device)
+    generator.manual_seed(int(rng.randint(0, 2**31)))
+
+    # Every spot starts as a random node, so the negatives and the missing positives are already filled in
+    samples = torch.randint(0, n_users, (n_users, n_pos + n_neg), generator=generator, device=device)
+
+    starts = indptr[:-1].long()
+    pool_sizes = indptr[1:].long() - starts
+
+    large_users = torch.nonzero(pool_sizes >= 2 * n_pos).squeeze(1)
+    offsets = _random_distinct_offsets_torch(pool_sizes[large_users], n_pos, generator)
+    samples[large_users, :n_pos] = indices[starts[large_users, None] + offsets].long()
+
+    small_users = torch.nonzero(pool_sizes < 2 * n_pos).squeeze(1)
+    small_sizes = pool_sizes[small_users]
+    small_starts = torch.cumsum(small_sizes, 0) - small_sizes  # start of each pool in the copied pools
+    pools = indices[torch.repeat_interleave(starts[small_users] - small_starts, small_sizes) 
+                    + torch.arange(int(small_sizes.sum()), device=device)]
+    random_fractions = torch.rand((n_pos, len(small_users)), generator=generator, device=device, dtype=torch.float64)
+    for j in range(n_pos):
+        users = torch.nonzero(small_sizes > j).squeeze(1)
+        swap_from = small_starts[users] + j
+        swap_to = swap_from + (random_fractions[j, users] * (small_sizes[users] - j)).long()
+        from_nodes, to_nodes = pools[swap_from], pools[swap_to]
+        pools[swap_from] = to_nodes
+        pools[swap_to] = from_nodes
+
+    columns = torch.arange(n_pos, device=device)
+    has_pos = columns < small_sizes[:, None]
+    small_samples = samples[small_users, :n_pos]
+    small_samples[has_pos] = pools[(small_starts[:, None] + columns)[has_pos]].long()
+    samples[small_users, :n_pos] = small_samples
+    return samples.cpu().numpy().astype(index_dtype(n_users))
 
+def _random_distinct_offsets_torch(sizes, k, generator):
+    """ Same as _random_distinct_offsets, for a tensor of pool sizes on the device of the generator. """
+    offsets = torch.empty((len(sizes), k), dtype=torch.int64, device=sizes.device)
+    for j in range(k):
+        random_fractions = torch.rand(len(sizes), generator=generator, device=sizes.device, dtype=torch.float64)
+        offsets[:, j] = (random_fractions * sizes).long()
+        repeated = torch.nonzero(torch.any(offsets[:, :j] == offsets[:, j, None], dim=1)).squeeze(1)
+        while len(repeated) > 0:
+            random_fractions = torch.rand(len(repeated), generator=generator, device=sizes.device, dtype=torch.float64)
+            offsets[repeated, j] = (random_fractions * sizes[repeated]).long()
+            repeated = repeated[torch.any(offsets[repeated, :j] == offsets[repeated, j, None], dim=1)]
+    return offsets
+
+def _get_device_graph_u2u(dataset, device):
+    """ Returns the CSR indptr and indices of dataset.graph_u2u as tensors on the device, keeping their integer types.
+        They are copied to the device once and cached on the dataset.
+    """
+    cached = getattr(dataset, "_device_graph_u2u", None)
+    if cached is None or cached[0].device != torch.device(device):
+        g_u2u = dataset.graph_u2u
+        assert g_u2u.format == "csr", "positive pools are read directly from the CSR index arrays"
+        indptr = torch.from_numpy(g_u2u.indptr).to(device)
+        indices = torch.from_numpy(g_u2u.indices).to(device)
+        cached = (indptr, indices)
+        dataset._device_graph_u2u = cached
+    return cached
+
+def _check_fill_sizes(indptr, n_users, n_pos, n_neg):
+    """ Raises a ValueError if some user would need more distinct random nodes to fill its missing positive or
+        negative samples than there are nodes, which could otherwise never be drawn.
+    """
+    pool_sizes = np.diff(indptr)
+    max_pos_fill = n_pos - pool_sizes.min(initial=n_pos)
+    max_neg_fill = n_neg - (n_users - pool_sizes.max(initial=0))
+    if max(max_pos_fill, max_neg_fill) > n_users:
+        raise ValueError("Cannot take a larger sample than population when 'replace=False'")
+
+def _sample_train_set_pos_neg_users_compiled(dataset, n_pos, n_neg, rng):
+    """ Same sampling as the normal python implementation, compiled with numba and parallelized over users.
+    """
+    g_u2u = dataset.graph_u2u
+    assert g_u2u.format == "csr", "positive pools are read directly from the CSR index arrays"
+    assert g_u2u.has_sorted_indices, "the kernel checks if a node is positive with a binary search"
+    _check_fill_sizes(g_u2u.indptr, dataset.n_users, n_pos, n_neg)
+    seed = rng.randint(0, 2**31)
+    samples = np.empty((dataset.n_users, n_pos + n_neg), dtype=index_dtype(dataset.n_users))
+    _sample_train_set_kernel(g_u2u.indptr, g_u2u.indices, dataset.n_users, n_pos, n_neg, seed, samples)
     return samples
 
-def BPR_UniformSample_original(dataset, neg_ratio = 1):
+if _numba:
+
+    @njit(cache=True)
+    def _random_distinct_nodes(n_users, k):
+        """ Draws k distinct random nodes, assumes k is small compared to n_users. """
+        nodes = np.empty(k, dtype=np.int64)
+        n_drawn = 0
+        while n_drawn < k:
+            node = np.random.randint(0, n_users)
+            if not np.any(nodes[:n_drawn] == node):
+                nodes[n_drawn] = node
+                n_drawn += 1
+        return nodes
+
+    @njit(cache=True)
+    def _choose_distinct(pool, out):
+        """ Fills out with distinct random elements of pool, assumes len(out) <= len(pool).
+            Small samples draw random positions and reject repeats, so the pool is never copied.
+            Larger samples run a partial Fisher-Yates shuffle on a copy of the pool.
+        """
+        k = len(out)
+        n = len(pool)
+        if 2 * k <= n:
+            positions = np.empty(k, dtype=np.int64)
+            n_drawn = 0
+            while n_drawn < k:
+                position = np.random.randint(0, n)
+                if not np.any(positions[:n_drawn] == position):
+                    positions[n_drawn] = position
+                    out[n_drawn] = pool[position]
+                    n_drawn += 1
+        else:
+            shuffled = pool.copy()
+            for j in range(k):
+                swap = np.random.randint(j, n)
+                shuffled[j], shuffled[swap] = shuffled[swap], shuffled[j]
+                out[j] = shuffled[j]
+
+    @njit(cache=True)
+    def _in_sorted(sorted_pool, node):
+        j = np.searchsorted(sorted_pool, node)
+        return j < len(sorted_pool) and sorted_pool[j] == node
+
+    @njit(parallel=True, nogil=True, cache=True)
+    def _sample_train_set_kernel(indptr, indices, n_users, n_pos, n_neg, seed, samples):
+
+        for i in prange(n_users):
+            # Seed every user separately so that the samples do not depend on thread scheduling
+            np.random.seed(np.uint32(seed + i))
+            pos_pool = indices[indptr[i]:indptr[i + 1]]
+            n_pos_pool = len(pos_pool)
+            n_neg_pool = n_users - n_pos_pool
+
+            if n_pos_pool >= n_pos:
+                _choose_distinct(pos_pool, samples[i, :n_pos])
+            else:
+                samples[i, :n_pos_pool] = pos_pool
+                samples[i, n_pos_pool:n_pos] = _random_distinct_nodes(n_users, n_pos - n_pos_pool)
+
+            if n_neg_pool >= max(2 * n_neg, n_users // 2):
+                # Rejection sampling of distinct negatives
+                k = n_pos
+                while k < n_pos + n_neg:
+                    node = np.random.randint(0, n_users)
+                    if not _in_sorted(pos_pool, node) and not np.any(samples[i, n_pos:k] == node):
+                        samples[i, k] = node
+                        k += 1
+            else:
+                # Build the negative pool as the complement of the sorted positive pool
+                neg_pool = np.empty(n_neg_pool, dtype=np.int64)
+                j = 0
+                k = 0
+                for node in range(n_users):
+                    if j < n_pos_pool and pos_pool[j] == node:
+                        j += 1
+                    else:
+                        neg_pool[k] = node
+                        k += 1
+                if n_neg_pool >= n_neg:
+                    _choose_distinct(neg_pool, samples[i, n_pos:])
+                else:
+                    samples[i, n_pos:n_pos + n_neg_pool] = neg_pool
+                    samples[i, n_pos + n_neg_pool:] = _random_distinct_nodes(n_users, n_neg - n_neg_pool)
+
+class Triplets(NamedTuple):
+    """ BPR training triplets stored as three separate contiguous arrays, 
+        so each of the users, positive items and negative items can be read with stride 1.
+    """
+    users: np.ndarray
+    pos_items: np.ndarray
+    neg_items: np.ndarray
+
+    @staticmethod
+    def from_2d(S: np.ndarray) -> 'Triplets':
+        """ Creates triplets from a (n, 3) array with a [user, positem, negitem] row for each triplet. """
+        S = np.asarray(S).reshape(-1, 3)
+        S = S.astype(index_dtype(S.max(initial=0) + 1), copy=False)
+        users, pos_items, neg_items = np.ascontiguousarray(S.T)
+        return Triplets(users, pos_items, neg_items)
+
+    def as_2d(self) -> np.ndarray:
+        """ Returns the triplets as a (n, 3) array with a [user, positem, negitem] row for each triplet. """
+        return np.column_stack(self)
+
+def BPR_UniformSample_original(dataset, neg_ratio = 1) -> Triplets:
     dataset : BasicDataset
     if _sample_ext:
         S = _sampling.sample_negative(dataset.n_users, dataset.m_items,
                                      dataset.trainDataSize, _get_positive_items(dataset), neg_ratio)
-    else:
-        S = _BPR_UniformSample_original_python(dataset)
-    return S
+        return Triplets.from_2d(S)
+    return _BPR_UniformSample_original_python(dataset)
 
 def _get_positive_items(dataset):
-    allPos = []
-    for i in range(dataset.graph_u2i.shape[0]):
-        row_slice = dataset.graph_u2i[i] 
-        indices = row_slice.nonzero()[1]
-        allPos.append(indices)
+    """ Returns a list with the array of positive item indices of each user.
+        The positives do not change between epochs, so they are built once and cached on the dataset.
+    """
+    allPos = getattr(dataset, "_positive_items", None)
+    if allPos is not None:
+        return allPos
+
+    # Split the indices of the CSR graph at the row boundaries
+    g_u2i = _get_positive_item_graph(dataset)
+    allPos = np.split(g_u2i.indices, g_u2i.indptr[1:-1])
+    dataset._positive_items = allPos
     return allPos
 
+def _get_positive_item_graph(dataset):
+    """ Returns the user to item graph as a binary CSR matrix with sorted indices, without explicitly stored zeros.
+        The positive items of user u are indices[indptr[u]:indptr[u + 1]]. It is built once and cached on the dataset.
+    """
+    g_u2i = getattr(dataset, "_positive_item_graph", None)
+    if g_u2i is None:
+        g_u2i = (dataset.graph_u2i != 0).tocsr()
+        # With sorted indices, looking up (user, item) entries binary searches each row instead of scanning it
+        g_u2i.sort_indices()
+        dataset._positive_item_graph = g_u2i
+    return g_u2i
+
 def _BPR_UniformSample_original_python(dataset):
     """
     the original impliment of BPR Sampling in LightGCN
     :return:
-        np.array
+        Triplets
+    """
+    users, positems, negitems = BPR_BatchedSample(dataset, k_pos=1, m_neg=1)
+    return Triplets(users, positems.ravel(), negitems.ravel())
+
+def BPR_BatchedSample(dataset, k_pos: int, m_neg: int) -> Triplets:
+    """ Samples k_pos positive items and m_neg negative items for random users in a single call.
+        Like the original BPR sampling, n_users users are drawn with replacement and users without positive items are skipped.
+        Returns Triplets whose pos_items and neg_items have shapes (n, k_pos) and (n, m_neg), 
+        so the k_pos * m_neg pairs of a row can all be used as BPR triplets.
+        Positives of a user are drawn with replacement.
     """
     dataset : BasicDataset
     #user_num = dataset.trainDataSize
     user_num = dataset.n_users
-    users = np.random.randint(0, dataset.n_users, user_num)
+    users = np.random.randint(0, dataset.n_users, user_num, dtype=index_dtype(dataset.n_users))
     
-    # List of positive item indices in each row
-    allPos = _get_positive_items(dataset)
-
-    S = []
-    for i, user in enumerate(users):
-        posForUser = allPos[user]
-        if len(posForUser) == 0:
-            continue
-        posindex = np.random.randint(0, len(posForUser))
-        positem = posForUser[posindex]
-        while True:
-            negitem = np.random.randint(0, dataset.m_items)
-            if negitem in posForUser:
-                continue
-            else:
-                break
-        S.append([user, positem, negitem])
-    return np.array(S)
\ No newline at end of file
+    # Users without positive items are skipped
+    g_u2i = _get_positive_item_graph(dataset)
+    n_pos = g_u2i.indptr[users + 1] - g_u2i.indptr[users]
+    users = users[n_pos > 0]
+    n_pos = n_pos[n_pos > 0]
+
+    # Draw random offsets into the positive items of every user at once
+    offsets = np.random.randint(0, n_pos[:, None], size=(len(users), k_pos))
+    positems = g_u2i.indices[g_u2i.indptr[users][:, None] + offsets].astype(index_dtype(dataset.m_items))
+    negitems = np.empty((len(users), m_neg), dtype=index_dtype(dataset.m_items))
+    for j in range(m_neg):
+        negitems[:, j] = _sample_negative_items(dataset, users)
+    return Triplets(users, positems, negitems)
+
+def _sample_negative_items(dataset, users, n_candidates=4):
+    """ Samples a random item that each user did not review.
+        n_candidates random items are drawn for every user at once, and the first one which is not in the graph is kept.
+        The few users whose candidates were all reviewed are sampled one at a time against a set of their items.
+    """
+    g_u2i = _get_positive_item_graph(dataset)
+    m_items = dataset.m_items
+    negitems = np.empty(len(users), dtype=index_dtype(m_items))
+
+    candidates = np.random.randint(0, m_items, size=(len(users), n_candidates))
+    candidate_users = np.repeat(users, n_candidates)
+    is_neg = np.asarray(g_u2i[candidate_users, candidates.ravel()]).reshape(candidates.shape) == 0
+    has_neg = is_neg.any(axis=1)
+    first_neg = is_neg.argmax(axis=1)
+    negitems[has_neg] = candidates[has_neg, first_neg[has_neg]]
+
+    for k in np.flatnonzero(~has_neg):
+        posForUser = _get_positive_item_set(dataset, users[k])
+        negitem = np.random.randint(0, m_items)
+        while negitem in posForUser:
+            negitem = np.random.randint(0, m_items)
+        negitems[k] = negitem
+    return negitems
+
+def _get_positive_item_set(dataset, user):
+    """ Returns a frozenset of the positive items of a user, for constant time membership tests.
+        Sets are only built for the users that need them and are cached on the dataset.
+    """
+    sets = getattr(dataset, "_positive_item_sets", None)
+    if sets is None:
+        sets = dataset._positive_item_sets = {}
+    user = int(user)
+    if user not in sets:
+        sets[user] = frozenset(_get_positive_items(dataset)[user].tolist())
+    return sets[user]
\ No newline at end of file
@@ -8,6 +8,15 @@ from .loss import SimilarityLoss, BPRLoss
 from .lightgcn import LightGCN
 from . import sampling 
 
+def autocast(model_config):
+    """ Returns a bf16 autocast context for the forward pass and loss computation.
+        Autocast is only enabled if mixed precision is configured and the model is on a GPU.
+        Parameters and optimizer steps stay in fp32.
+    """
+    device_type = model_config.device.type
+    enabled = model_config.train_config.mixed_precision and device_type == "cuda"
+    return torch.autocast(device_type=device_type, dtype=torch.bfloat16, enabled=enabled)
+
 def train_lightgcn_simi_loss(dataset: BasicDataset, model: LightGCN, model_loss: SimilarityLoss, optimizer: torch.optim.Optimizer, epoch: int, logger):
 
     # Put the model in training mode
@@ -19,54 +28,66 @@ def train_lightgcn_simi_loss(dataset: BasicDataset, model: LightGCN, model_loss:
     batch_size = config.batch_size
 
     # Generates positive and negative samples at the start of each epoch
+    # With prefetching, this only waits for the samples drawn in the background during the last epoch
     logger.debug(f"EP[{epoch}]: Sampling positive and negative user nodes...")
-    with utils.timer(name="Sampling"):
-        samples = model_loss.sample_train_set_pos_neg_users()
+    with utils.timer(name="Sampling_wait"):
+        samples, sample_simi = model_loss.sample_epoch()
     logger.debug(f"EP[{epoch}]: Positive and negative user nodes sampled.")
 
+    # Sample the next epoch in the background while this epoch trains
+    if epoch + 1 < config.epochs:
+        model_loss.prefetch_epoch()
+
     # Get indices of all nodes in random order
     user_nodes = np.random.permutation(dataset.n_users)
     item_nodes = np.arange(dataset.m_items)
-    n_batches = math.ceil(len(user_nodes) // batch_size)
+    n_batches = math.ceil(len(user_nodes) / batch_size)
+
+    # Reorder the samples and their similarities to match user_nodes once, so each batch is a contiguous slice
+    samples = samples[user_nodes]
+    sample_simi = sample_simi[torch.as_tensor(user_nodes, device=sample_simi.device)]
+    batches = [(user_nodes[i * batch_size: (i + 1) * batch_size], 
+                samples[i * batch_size: (i + 1) * batch_size],
+                sample_simi[i * batch_size: (i + 1) * batch_size]) for i in range(n_batches)]
 
-    optimizer.zero_grad()
-    model.zero_grad()
+    optimizer.zero_grad(set_to_none=True)
 
     loss_sum = 0
-    avg_loss = 0
-    visited_user_nodes = set()
+    n_batches_trained = 0
+    visited_user_nodes = np.zeros(dataset.n_users, dtype=bool)
+    n_visited_user_nodes = 0
 
     with utils.timer(name="Training"):
-        for i in range(n_batches):
-            nodes_batch = user_nodes[i * batch_size: (i + 1) * batch_size]
-            extended_nodes_batch = model_loss.extend_user_node_batch(nodes_batch, samples)
+        for nodes_batch, samples_batch, sample_simi_batch in batches:
+            extended_nodes_batch = model_loss.extend_user_node_batch(nodes_batch, samples_batch)
 
-            # Add the nodes in this batch and the sampled nodes for this batch to visited set
-            visited_user_nodes |= set(extended_nodes_batch)
+            # Mark the nodes in this batch and the sampled nodes for this batch as visited
+            n_visited_user_nodes += len(extended_nodes_batch) - np.count_nonzero(visited_user_nodes[extended_nodes_batch])
+            visited_user_nodes[extended_nodes_batch] = True
 
-            with utils.timer(name="Forward"):
+            with utils.timer(name="Forward"), autocast(model_config):
                 all_user_embs, all_item_embs = model() # Get all user and item embeddings
 
-            with utils.timer(name="Loss"):
-                loss = model_loss.get_loss(nodes_batch, user_embs=all_user_embs, samples=samples)
+            with utils.timer(name="Loss"), autocast(model_config):
+                loss = model_loss.get_loss(nodes_batch, user_embs=all_user_embs, samples=samples_batch, sample_simi=sample_simi_batch)
                 loss_sum += loss.item()
+                n_batches_trained += 1
 
             with utils.timer(name="Backward"):
                 loss.backward()
                 optimizer.step()
-
-                optimizer.zero_grad()
-                model.zero_grad()
+                optimizer.zero_grad(set_to_none=True)
 
             # Stop when all nodes are trained, this may be before all batches are used    
-            if len(visited_user_nodes) == len(user_nodes):
-                avg_loss = loss_sum / (i + 1)
+            if n_visited_user_nodes == len(user_nodes):
                 break
     
-    time_info = utils.timer.formatted_tape_str(select_keys=["Sampling", "Training"])
+    avg_loss = loss_sum / n_batches_trained
+    time_info = utils.timer.formatted_tape_str(select_keys=["Sampling_wait", "Training"])
     training_time_info = utils.timer.formatted_tape_str(select_keys=["Forward", "Loss", "Backward"])
     utils.timer.zero()
-    logger.info(f"EPOCH {epoch} complete. Average Loss: {avg_loss:.4f}, Time: {time_info}")  
+    sampling_time_info = f"|Sampling:{utils.timer.format_time_dhms(model_loss.sampling_time)}"
+    logger.info(f"EPOCH {epoch} complete. Average Loss: {avg_loss:.4f}, Time: {sampling_time_info}{time_info}")  
     logger.debug(f"Training time: {training_time_info}")          
 
     return avg_loss
@@ -112,22 +133,16 @@ def train_lightgcn_bpr_loss(dataset: BasicDataset, model: LightGCN, bpr_loss: BP
     model_config = model.config
     config = model_config.train_config
     batch_size = config.batch_size
-    device = model_config.device
 
     with utils.timer(name="BPR_Sampling"):
         S = sampling.BPR_UniformSample_original(dataset)
         
-        users = torch.Tensor(S[:, 0]).long()
-        posItems = torch.Tensor(S[:, 1]).long()
-        negItems = torch.Tensor(S[:, 2]).long()
-
-        users = users.to(device)
-        posItems = posItems.to(device)
-        negItems = negItems.to(device)
+        # Copy the users, positive items and negative items to the device together, without a float round trip
+        users, posItems, negItems = bpr_loss._to_device(np.stack(S))
         users, posItems, negItems = shuffle(users, posItems, negItems)
 
     with utils.timer(name="BPR_Training"):
-        n_batches = len(users) // batch_size + 1
+        n_batches = math.ceil(len(users) / batch_size)
         loss_sum = 0.
         for (batch_i,
             (batch_users,
@@ -137,9 +152,10 @@ def train_lightgcn_bpr_loss(dataset: BasicDataset, model: LightGCN, bpr_loss: BP
                                                     posItems,
                                                     negItems)):
 
-            loss = bpr_loss.get_loss(*model.getEmbeddingsForBPR(batch_users, batch_pos, batch_neg))
+            with autocast(model_config):
+                loss = bpr_loss.get_loss(*model.getEmbeddingsForBPR(batch_users, batch_pos, batch_neg))
 
-            optimizer.zero_grad()
+            optimizer.zero_grad(set_to_none=True)
             loss.backward()
             optimizer.step()
             loss_sum += loss.item()
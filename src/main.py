@@ -45,13 +45,17 @@ def embedding_main(args, dataset, results_path, logger):
     else:
         logger.info(f"No GPU available. CPU will be used for training.")
 
+    if args.amp and not GPU:
+        logger.info("Mixed precision training is only supported on GPU and will be disabled.")
+
     # Set configurations
     train_config = LightGCNTrainingConfig(
         epochs = args.epochs,
         batch_size = args.batch_size,
         learning_rate = args.lr,
         dropout = args.dropout,
-        weight_decay = args.decay
+        weight_decay = args.decay,
+        mixed_precision = args.amp
     )
 
     lightgcn_config = LightGCNConfig(
@@ -77,7 +81,8 @@ def embedding_main(args, dataset, results_path, logger):
         loss = BPRLoss(device, dataset, weight_decay=train_config.weight_decay)
         train_lightgcn = training.train_lightgcn_bpr_loss
     elif args.loss == "simi":
-        loss = SimilarityLoss(device, dataset, n_pos=10, n_neg=10, fast_sampling=args.fast_simi)
+        loss = SimilarityLoss(device, dataset, n_pos=10, n_neg=10, fast_sampling=args.fast_simi, 
+                              gpu_sampling=args.gpu_simi_sampling)
         if loss.fast_sampling:
             logger.info(f"Adjusted n_pos {loss.n_pos}, n_neg {loss.n_neg}")
         train_lightgcn = training.train_lightgcn_simi_loss
@@ -90,8 +95,11 @@ def embedding_main(args, dataset, results_path, logger):
     logger.info(f"LightGCN configured to produce {lightgcn_config.latent_dim} dimensional embeddings.")
 
     losses = np.zeros(train_config.epochs)
-    for epoch in range(train_config.epochs):
-        losses[epoch] = train_lightgcn(dataset, lightgcn, loss, optimizer, epoch, logger)
+    try:
+        for epoch in range(train_config.epochs):
+            losses[epoch] = train_lightgcn(dataset, lightgcn, loss, optimizer, epoch, logger)
+    finally:
+        loss.close() # stop any background sampling, also when training fails
 
     if args.plot:
         loss_plot_file = results_path / "loss.png"
@@ -273,6 +281,12 @@ if __name__ == "__main__":
     parser.add_argument("--fast_simi", action="store_true", help="faster sampling for simi loss, use for very large & sparse datasets")
     parser.add_argument("--no_fast_simi", action="store_false", dest="fast_simi", help="disable fast sampling for simi loss")
     parser.set_defaults(fast_simi=True)
+    parser.add_argument("--gpu_simi_sampling", action="store_true", help="do fast sampling for simi loss on the GPU, keeps a copy of the user-user graph on the GPU")
+    parser.add_argument("--no_gpu_simi_sampling", action="store_false", dest="gpu_simi_sampling", help="do fast sampling for simi loss on the CPU")
+    parser.set_defaults(gpu_simi_sampling=False)
+    parser.add_argument("--amp", action="store_true", help="enable bf16 mixed precision for the forward pass and loss, GPU only")
+    parser.add_argument("--no_amp", action="store_false", dest="amp", help="disable bf16 mixed precision")
+    parser.set_defaults(amp=False)
 
     # Arguments for clustering and anomaly scores
     parser.add_argument("--clustering", type=str, default="hclust", help="The clustering algorithm to use. Options: hclust, hdbscan, dbscan, none")
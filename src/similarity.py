@@ -1,85 +1,256 @@
-from bitarray import bitarray
+import logging
 from scipy.sparse import csr_matrix
+import numpy as np
+
+try:
+    from numba import njit, types
+    from numba.extending import intrinsic
+    _numba = True
+except ImportError:
+    logging.getLogger("Logger").info("numba not installed, bitset operations will not be compiled")
+    _numba = False
+
+# Maximum number of user pairs materialized at once by get_jaccard_similarity_sum
+JACCARD_CHUNK_PAIRS = 2**22
+# Below this many intersected bitset words, popcounts of the packed bitsets are cheaper than building sparse matrices
+JACCARD_SMALL_WORDS = 2**14
+# Maximum number of dense matrix entries unpacked at once when packing the user bitsets
+PACK_CHUNK_ENTRIES = 2**24
+# items_in_common_pairs intersects packed bitsets instead of sparse rows if the bitsets have at most this many words,
+# or at most this many words per item of the average user, since sparse intersections scale with the items per user
+PAIRS_BITSET_MIN_WORDS = 16
+PAIRS_BITSET_WORDS_PER_ITEM = 3
+# Maximum number of bitset words intersected at once by items_in_common_pairs
+PAIRS_CHUNK_WORDS = 2**22
+
+# Number of set bits in each possible byte, used when numpy does not provide bitwise_count
+_BYTE_POPCOUNTS = np.unpackbits(np.arange(256, dtype=np.uint8)[:, None], axis=1).sum(axis=1)
+
+def popcount(words: np.ndarray, axis=None):
+    """
+    Counts the set bits of a uint64 bitset array, summed over the given axis (all bits by default).
+    Uses np.bitwise_count when available (numpy >= 2.0), and a byte lookup table otherwise.
+    """
+    if hasattr(np, "bitwise_count"):
+        counts = np.bitwise_count(words)
+    else:
+        words = np.ascontiguousarray(words)
+        counts = _BYTE_POPCOUNTS[words.view(np.uint8)].reshape(*words.shape, 8).sum(axis=-1)
+    return counts.sum(axis=axis, dtype=np.int64)
+
+def bitwise_or_count(a: np.ndarray, b: np.ndarray):
+    """
+    Returns the bitwise OR of two uint64 bitsets and the number of set bits in it.
+    With numba, the OR and the popcount are fused into a single pass over the words.
+    """
+    if _numba:
+        return _bitwise_or_count_compiled(a, b)
+    union = np.bitwise_or(a, b)
+    return union, int(popcount(union))
+
+def bitwise_and_count(a: np.ndarray, b: np.ndarray):
+    """
+    Returns the bitwise AND of two uint64 bitsets and the number of set bits in it.
+    With numba, the AND and the popcount are fused into a single pass over the words.
+    """
+    if _numba:
+        return _bitwise_and_count_compiled(a, b)
+    intersection = np.bitwise_and(a, b)
+    return intersection, int(popcount(intersection))
+
+if _numba:
+
+    @intrinsic
+    def _popcount64(typingctx, word):
+        """ Counts the set bits of a uint64 word with llvm's ctpop, which compiles to a popcnt instruction. """
+        def codegen(context, builder, signature, args):
+            return builder.ctpop(args[0])
+        return types.uint64(types.uint64), codegen
+
+    @njit(cache=True)
+    def _bitwise_or_count_compiled(a, b):
+        out = np.empty_like(a)
+        count = 0
+        for i in range(len(a)):
+            out[i] = a[i] | b[i]
+            count += _popcount64(out[i])
+        return out, count
+
+    @njit(cache=True)
+    def _bitwise_and_count_compiled(a, b):
+        out = np.empty_like(a)
+        count = 0
+        for i in range(len(a)):
+            out[i] = a[i] & b[i]
+            count += _popcount64(out[i])
+        return out, count
 
 class UserSimilarity:
     """
     Class for computing similarities between 2 user nodes.
     Replaces large np array of pairwise similarities that may not be able to fit in memory.
-    Takes user to item sparse matrix as input. Internally represents users as bitarrays.
+    Takes user to item sparse matrix as input. 
+    Internally represents users as bitsets packed into a (n_users, ceil(n_items / 64)) uint64 matrix.
     Similarities are computed lazily and efficiently when queried.
     """
 
     def __init__(self, graph_u2i: csr_matrix):
         self._graph_u2i = graph_u2i
         self._n_users = graph_u2i.shape[0]
+        self._n_items = graph_u2i.shape[1]
         self.shape = (self._n_users, self._n_users)
-        self._init_bitarrays()
-
-    def _init_bitarrays(self):
-        self._user_bitarrays = []
-
-        for row in range(self._n_users):
-            user_vector = self._graph_u2i.getrow(row)
-            user_bitarray = self._user_vector_to_bitarray(user_vector)
-            self._user_bitarrays.append(user_bitarray)
-
-    def _user_vector_to_bitarray(self, user_vector):
-        """Converts a user vector in sparse format (row vector) to a bitarray."""
-        non_zero_row_indices, non_zero_column_indices = user_vector.nonzero()
-        bit_array = bitarray(user_vector.shape[1])
-        bit_array.setall(0)
-        for i in non_zero_column_indices:
-            bit_array[i] = 1
-        return bit_array
-    
-    def get_user_bitarray(self, user_index):
-        return self._user_bitarrays[user_index]
+
+        # Binary user to item incidence matrix used for vectorized similarity computations
+        self._incidence = (graph_u2i != 0).astype(np.float32).tocsr()
+        self._user_item_counts = np.diff(self._incidence.indptr)
+        self._init_bitsets()
+
+        # Shared read-only bitset for empty item sets, so groups with empty intersections do not each allocate one
+        self._empty_bitset = np.zeros(self.n_words, dtype=np.uint64)
+        self._empty_bitset.flags.writeable = False
+
+    def _init_bitsets(self):
+        """Packs the item set of every user into the rows of a uint64 matrix, a few users at a time."""
+        chunk_size = max(1, PACK_CHUNK_ENTRIES // max(1, self._n_items))
+        self._packed = np.empty((self._n_users, self.n_words), dtype=np.uint64)
+        for start in range(0, self._n_users, chunk_size):
+            rows = self._incidence[start:start + chunk_size].toarray() != 0
+            self._packed[start:start + chunk_size] = self.mask_to_bitset(rows)
+
+    @property
+    def n_words(self):
+        """Number of uint64 words in the bitset of a user."""
+        return (self._n_items + 63) // 64
     
-    def get_user_bitarrays(self, user_indices):
-        return [self._user_bitarrays[i] for i in user_indices]
+    def get_user_item_counts(self, user_indices):
+        """Gets the number of items reviewed by each of the given users."""
+        return self._user_item_counts[user_indices]
+
+    def get_empty_bitset(self):
+        """Gets the shared read-only bitset of an empty item set."""
+        return self._empty_bitset
+
+    def get_user_bitset(self, user_index):
+        return self._packed[user_index]
     
+    def get_user_bitsets(self, user_indices):
+        return self._packed[user_indices]
+
+    @staticmethod
+    def mask_to_bitset(mask: np.ndarray):
+        """
+        Packs a boolean numpy array into uint64 words along its last axis.
+        Bit j of an item set is stored in word j // 64, so masks of the same length give compatible bitsets.
+        """
+        mask = np.asarray(mask, dtype=bool)
+        n_words = (mask.shape[-1] + 63) // 64
+        padding = [(0, 0)] * (mask.ndim - 1) + [(0, 64 * n_words - mask.shape[-1])]
+        packed_bytes = np.packbits(np.pad(mask, padding), axis=-1, bitorder="little")
+        return np.ascontiguousarray(packed_bytes).view("<u8").astype(np.uint64)
+
     def get_jaccard_similarity(self, u1: int, u2: int):
         """
         Gets the jaccard similarity between user1 and user2 using their indices.
         """
-        u1 = self.get_user_bitarray(u1)
-        u2 = self.get_user_bitarray(u2)
-        intersection = u1 & u2
-        union = u1 | u2
-        union_count = union.count()
-        intersection_count = intersection.count()
+        u1 = self.get_user_bitset(u1)
+        u2 = self.get_user_bitset(u2)
+        union_count = popcount(u1 | u2)
+        intersection_count = popcount(u1 & u2)
 
         if union_count == 0:
             return 1
         
         return intersection_count / union_count
 
+    def get_jaccard_similarity_sum(self, users1, users2):
+        """
+        Gets the sum of the jaccard similarities between every user in users1 and every user in users2.
+        All pairwise intersections are computed at once as a sparse matrix product of the users' item vectors.
+        Unions are derived from the intersections as |A| + |B| - |A & B|.
+        Small groups of pairs are intersected directly with the packed bitsets, avoiding the matrix setup cost.
+        """
+        users1 = np.asarray(users1)
+        users2 = np.asarray(users2)
+        sizes2 = self._user_item_counts[users2]
+
+        if len(users1) * len(users2) * self.n_words <= JACCARD_SMALL_WORDS:
+            intersection = popcount(self._packed[users1][:, None, :] & self._packed[users2][None, :, :], axis=-1)
+            union = self._user_item_counts[users1][:, None] + sizes2[None, :] - intersection
+            return float(np.where(union > 0, intersection / np.where(union > 0, union, 1), 1).sum())
+
+        m2 = self._incidence[users2]
+        chunk_size = max(1, JACCARD_CHUNK_PAIRS // len(users2))
+
+        similarity_sum = 0.0
+        for start in range(0, len(users1), chunk_size):
+            chunk = users1[start:start + chunk_size]
+            intersection = (self._incidence[chunk] @ m2.T).toarray()
+            union = self._user_item_counts[chunk][:, None] + sizes2[None, :] - intersection
+            # Two users with no items have an empty union, which get_jaccard_similarity defines as similarity 1
+            similarity_sum += np.where(union > 0, intersection / np.where(union > 0, union, 1), 1).sum()
+        return float(similarity_sum)
+
     def get_smoothed_jaccard_similarity(self, u1: int , u2: int):
         """
         Gets the smoothed jaccard similarity between user1 and user2.
         """
-        u1 = self.get_user_bitarray(u1)
-        u2 = self.get_user_bitarray(u2)
-        intersection = u1 & u2
-        union = u1 | u2
-        union_count = union.count()
-        intersection_count = intersection.count()
+        u1 = self.get_user_bitset(u1)
+        u2 = self.get_user_bitset(u2)
+        union_count = popcount(u1 | u2)
+        intersection_count = popcount(u1 & u2)
 
         if intersection_count == 0:
-            simi_score = 1 / (union_count + len(u1))
+            simi_score = 1 / (union_count + self._n_items)
         elif intersection_count == union_count:
-            simi_score = (union_count + len(u1) - 1) / (union_count + len(u1))
+            simi_score = (union_count + self._n_items - 1) / (union_count + self._n_items)
         else:
             simi_score = intersection_count / union_count
         return float(simi_score)
     
+    def get_smoothed_jaccard_similarities(self, users1, users2):
+        """
+        Gets the smoothed jaccard similarity between each pair (users1[k], users2[k]).
+        Vectorized equivalent of get_smoothed_jaccard_similarity, returns a float32 numpy array.
+        """
+        users1 = np.asarray(users1)
+        users2 = np.asarray(users2)
+        n_items = self._incidence.shape[1]
+        intersection_count = self.items_in_common_pairs(users1, users2)
+        union_count = self._user_item_counts[users1] + self._user_item_counts[users2] - intersection_count
+
+        simi_scores = np.select(
+            [intersection_count == 0, intersection_count == union_count],
+            [1 / (union_count + n_items), (union_count + n_items - 1) / (union_count + n_items)],
+            default=intersection_count / np.maximum(union_count, 1)
+        )
+        return simi_scores.astype(np.float32)
+
     def items_in_common(self, u1: int, u2: int):
         """ 
         Returns the number of items in common between user1 and user2.
         In other words, the size of the intersection of their product sets.
         """
-        u1 = self.get_user_bitarray(u1)
-        u2 = self.get_user_bitarray(u2)
-        intersection = u1 & u2
-        items_in_common = intersection.count()
+        u1 = self.get_user_bitset(u1)
+        u2 = self.get_user_bitset(u2)
+        items_in_common = int(popcount(u1 & u2))
         return items_in_common
+
+    def items_in_common_pairs(self, users1, users2):
+        """
+        Returns the number of items in common between each pair (users1[k], users2[k]).
+        Vectorized equivalent of items_in_common. When the bitsets are short compared to the item sets, the packed 
+        bitsets of each pair are intersected and popcounted a chunk of pairs at a time. Otherwise, the rows of both 
+        users are intersected in a single sparse multiply.
+        """
+        users1 = np.asarray(users1)
+        users2 = np.asarray(users2)
+        mean_items = self._incidence.nnz / max(1, self._n_users)
+        if self.n_words <= max(PAIRS_BITSET_MIN_WORDS, PAIRS_BITSET_WORDS_PER_ITEM * mean_items):
+            counts = np.empty(len(users1), dtype=np.int64)
+            chunk_size = max(1, PAIRS_CHUNK_WORDS // max(1, self.n_words))
+            for start in range(0, len(users1), chunk_size):
+                end = start + chunk_size
+                counts[start:end] = popcount(self._packed[users1[start:end]] & self._packed[users2[start:end]], axis=1)
+            return counts
+        common = self._incidence[users1].multiply(self._incidence[users2]).tocsr()
+        return common.getnnz(axis=1)
@@ -0,0 +1,36 @@
+import numpy as np
+import pytest
+from scipy.sparse import csr_matrix
+
+from src.dataloader import GraphUser2ItemDataset
+
+
+def random_graph_u2i(n_users, m_items, max_items, seed):
+    """ Builds a random binary user to item graph where each user reviews 0 to max_items items.
+        The first 8 users form a farm which all review items 0 to 4, so some groups have common products.
+    """
+    rng = np.random.RandomState(seed)
+    dense = np.zeros((n_users, m_items), dtype=bool)
+    for user in range(n_users):
+        dense[user, rng.choice(m_items, rng.randint(0, max_items + 1), replace=False)] = True
+    dense[:8, :5] = True
+    return csr_matrix(dense.astype(np.float32))
+
+
+@pytest.fixture
+def graph_u2i():
+    """ Toy graph with 150 items, so item sets span several 64 bit words, and an explicitly stored zero. """
+    graph = random_graph_u2i(n_users=40, m_items=150, max_items=12, seed=0)
+    # Store a zero for an item user 39 did not review, it must not count as a reviewed item
+    item = np.flatnonzero(graph[39].toarray().ravel() == 0)[0]
+    graph = csr_matrix((np.append(graph.data, 0), np.append(graph.indices, item), 
+                        np.append(graph.indptr[:-1], graph.indptr[-1] + 1)), shape=graph.shape)
+    assert (graph.data == 0).sum() == 1
+    return graph
+
+
+@pytest.fixture
+def dataset():
+    """ Toy dataset with a wide spread of positive pool sizes for the pos/neg user samplers. """
+    graph = random_graph_u2i(n_users=80, m_items=120, max_items=6, seed=1)
+    return GraphUser2ItemDataset(graph, np.zeros(graph.shape[0], dtype=int))
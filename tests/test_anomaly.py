@@ -0,0 +1,57 @@
+import numpy as np
+import pytest
+
+from src.clustering.anomaly import AnomalyGroup, AnomalyScorer
+from src.similarity import UserSimilarity
+
+
+def brute_force_compactness(graph_u2i, users):
+    """ Group anomaly compactness without penalty, computed from the item sets of the users. """
+    sets = [set(np.flatnonzero(row)) for row in graph_u2i[users].toarray() != 0]
+    union = set().union(*sets)
+    common = set.intersection(*sets)
+    if len(common) == 0:
+        return 0
+    review_tightness = sum(len(items) for items in sets) / (len(users) * len(union))
+    product_tightness = len(common) / len(union)
+    jaccards = [len(a & b) / len(a | b) if a | b else 1 for a in sets for b in sets]
+    return review_tightness * product_tightness * np.mean(jaccards)
+
+
+def test_filter_small_groups_keeps_groups_of_min_size():
+    clusters = [[0], [1, 2], [3, 4, 5], [6, 7, 8, 9]]
+    anomaly_scores = np.array([0.1, 0.2, 0.3, 0.4])
+
+    filtered_clusters, filtered_scores = AnomalyScorer.filter_small_groups(clusters, anomaly_scores, min_group_size=3)
+    assert filtered_clusters == [[3, 4, 5], [6, 7, 8, 9]]
+    np.testing.assert_array_equal(filtered_scores, [0.3, 0.4])
+
+    filtered_clusters, filtered_scores = AnomalyScorer.filter_small_groups(clusters, anomaly_scores, min_group_size=5)
+    assert filtered_clusters == []
+    assert len(filtered_scores) == 0
+
+
+@pytest.mark.parametrize("users", [[0, 1, 2, 3, 4, 5, 6, 7], [0, 3, 5, 11, 20], [2, 6]])
+def test_make_group_compactness_matches_brute_force(graph_u2i, users):
+    user_simi = UserSimilarity(graph_u2i)
+    group = AnomalyGroup.make_group(users, user_simi)
+    assert group.group_anomaly_compactness() == pytest.approx(brute_force_compactness(graph_u2i, users))
+
+
+@pytest.mark.parametrize("splits", [[[0, 1, 2], [3, 4], [5, 6, 7]], [[0], [1, 2, 3, 4, 5, 6, 7], [30, 31]], [[0, 1], [39]]])
+def test_kary_and_pairwise_groups_match_make_group(graph_u2i, splits):
+    user_simi = UserSimilarity(graph_u2i)
+    users = np.concatenate(splits)
+    expected = AnomalyGroup.make_group(users, user_simi)
+
+    for make in (AnomalyGroup.make_kary_group, AnomalyGroup.make_group_from_many_children):
+        children = [AnomalyGroup.make_group(split, user_simi) for split in splits]
+        group = make(children, user_simi)
+        np.testing.assert_array_equal(group.users, expected.users)
+        np.testing.assert_array_equal(group.group_product_set_union, expected.group_product_set_union)
+        np.testing.assert_array_equal(group.group_product_set_intersection, expected.group_product_set_intersection)
+        assert group.n_total_reviews == expected.n_total_reviews
+        assert group.n_total_products_reviewed == expected.n_total_products_reviewed
+        assert group.n_common_products_reviewed == expected.n_common_products_reviewed
+        assert group._jaccard_similarity_sum() == pytest.approx(expected._jaccard_similarity_sum())
+        assert group.group_anomaly_compactness() == pytest.approx(brute_force_compactness(graph_u2i, users))
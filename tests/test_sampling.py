@@ -0,0 +1,74 @@
+import numpy as np
+import pytest
+from scipy.sparse import csr_matrix
+
+from src.dataloader import GraphUser2ItemDataset
+from src.embedding import sampling
+
+
+@pytest.fixture(params=["compiled", "python"])
+def sampler_backend(request, monkeypatch):
+    """ Runs a test with the numba kernel, when it is installed, and with the numpy samplers. """
+    if request.param == "compiled" and not sampling._numba:
+        pytest.skip("numba is not installed")
+    if request.param == "python":
+        monkeypatch.setattr(sampling, "_numba", False)
+    return request.param
+
+
+def positive_pools(dataset):
+    g_u2u = dataset.graph_u2u
+    return [set(g_u2u.indices[g_u2u.indptr[i]:g_u2u.indptr[i + 1]]) for i in range(dataset.n_users)]
+
+
+@pytest.mark.parametrize("fast", [False, True])
+def test_samples_are_deterministic_under_a_seed(dataset, sampler_backend, fast):
+    samples1 = sampling.sample_train_set_pos_neg_users(dataset, 4, 5, fast, np.random.RandomState(3))
+    samples2 = sampling.sample_train_set_pos_neg_users(dataset, 4, 5, fast, np.random.RandomState(3))
+    assert samples1.shape == (dataset.n_users, 9)
+    assert samples1.dtype == sampling.index_dtype(dataset.n_users)
+    np.testing.assert_array_equal(samples1, samples2)
+
+
+@pytest.mark.parametrize("fast", [False, True])
+def test_positive_samples_are_distinct_positives(dataset, sampler_backend, fast):
+    n_pos = 4
+    pools = positive_pools(dataset)
+    assert min(map(len, pools)) < n_pos <= max(map(len, pools)) // 2 # short, small and large pools are covered
+    samples = sampling.sample_train_set_pos_neg_users(dataset, n_pos, 5, fast, np.random.RandomState(4))
+
+    for user, pool in enumerate(pools):
+        positives = samples[user, :n_pos]
+        if len(pool) >= n_pos:
+            assert len(set(positives)) == n_pos
+            assert set(positives) <= pool
+        else:
+            # Users with too few positives get their whole pool followed by random nodes
+            assert set(positives[:len(pool)]) == pool
+
+
+def test_negative_samples_share_no_items(dataset, sampler_backend):
+    n_neg = 5
+    pools = positive_pools(dataset)
+    samples = sampling.sample_train_set_pos_neg_users(dataset, 4, n_neg, False, np.random.RandomState(5))
+
+    items = dataset.graph_u2i.toarray() != 0
+    for user, pool in enumerate(pools):
+        negatives = samples[user, 4:]
+        assert len(set(negatives)) == n_neg
+        if dataset.n_users - len(pool) >= n_neg:
+            assert not np.any(items[negatives] & items[user])
+
+
+def test_missing_positives_only_need_distinct_fill_nodes(sampler_backend):
+    # Pairs of users review the same item, so every positive pool has 2 users and n_pos - 2 nodes are filled in
+    graph_u2i = csr_matrix(np.repeat(np.eye(3, dtype=np.float32), 2, axis=0))
+    dataset = GraphUser2ItemDataset(graph_u2i, np.zeros(6, dtype=int))
+
+    samples = sampling.sample_train_set_pos_neg_users(dataset, 8, 0, False, np.random.RandomState(6))
+    assert samples.shape == (6, 8)
+    for user in range(6):
+        assert set(samples[user, :2]) == {user - user % 2, user - user % 2 + 1}
+        assert len(set(samples[user, 2:])) == 6
+    with pytest.raises(ValueError):
+        sampling.sample_train_set_pos_neg_users(dataset, 9, 0, False, np.random.RandomState(6))
@@ -0,0 +1,73 @@
+import numpy as np
+import pytest
+from scipy.sparse import csr_matrix
+
+import src.similarity as similarity
+from src.similarity import UserSimilarity
+
+
+def item_sets(graph_u2i):
+    return [set(np.flatnonzero(row)) for row in graph_u2i.toarray() != 0]
+
+
+def jaccard(items1, items2):
+    """ Jaccard similarity of two item sets, where two empty sets have similarity 1. """
+    union = len(items1 | items2)
+    return 1 if union == 0 else len(items1 & items2) / union
+
+
+@pytest.fixture
+def user_pairs():
+    rng = np.random.RandomState(2)
+    return rng.randint(0, 40, size=300), rng.randint(0, 40, size=300)
+
+
+def test_explicit_zeros_are_not_items(graph_u2i):
+    user_simi = UserSimilarity(graph_u2i)
+    sets = item_sets(graph_u2i)
+    assert list(user_simi.get_user_item_counts(np.arange(40))) == [len(items) for items in sets]
+
+
+@pytest.mark.parametrize("small_words", [similarity.JACCARD_SMALL_WORDS, 0])
+def test_jaccard_similarity_sum_matches_brute_force(graph_u2i, monkeypatch, small_words):
+    # Small groups use the packed bitsets, larger ones the chunked sparse product
+    monkeypatch.setattr(similarity, "JACCARD_SMALL_WORDS", small_words)
+    monkeypatch.setattr(similarity, "JACCARD_CHUNK_PAIRS", 64)
+    user_simi = UserSimilarity(graph_u2i)
+    sets = item_sets(graph_u2i)
+    users1 = np.array([0, 1, 2, 7, 8, 20, 39, 39])
+    users2 = np.arange(40)
+
+    expected = sum(jaccard(sets[u1], sets[u2]) for u1 in users1 for u2 in users2)
+    assert user_simi.get_jaccard_similarity_sum(users1, users2) == pytest.approx(expected)
+    expected = sum(user_simi.get_jaccard_similarity(u1, u2) for u1 in users1 for u2 in users2)
+    assert user_simi.get_jaccard_similarity_sum(users1, users2) == pytest.approx(expected)
+
+
+def test_jaccard_similarity_sum_of_empty_item_sets():
+    user_simi = UserSimilarity(csr_matrix((3, 10)))
+    assert user_simi.get_jaccard_similarity_sum([0, 1], [0, 1, 2]) == 6
+
+
+@pytest.mark.parametrize("bitset_path", [True, False])
+def test_items_in_common_pairs_matches_brute_force(graph_u2i, user_pairs, monkeypatch, bitset_path):
+    if bitset_path:
+        monkeypatch.setattr(similarity, "PAIRS_BITSET_MIN_WORDS", 2**10)
+        monkeypatch.setattr(similarity, "PAIRS_CHUNK_WORDS", 32)
+    else:
+        monkeypatch.setattr(similarity, "PAIRS_BITSET_MIN_WORDS", 0)
+        monkeypatch.setattr(similarity, "PAIRS_BITSET_WORDS_PER_ITEM", 0)
+    user_simi = UserSimilarity(graph_u2i)
+    sets = item_sets(graph_u2i)
+    users1, users2 = user_pairs
+
+    expected = [len(sets[u1] & sets[u2]) for u1, u2 in zip(users1, users2)]
+    assert list(user_simi.items_in_common_pairs(users1, users2)) == expected
+
+
+def test_smoothed_jaccard_similarities_match_single_pairs(graph_u2i, user_pairs):
+    user_simi = UserSimilarity(graph_u2i)
+    users1, users2 = user_pairs
+
+    expected = [user_simi.get_smoothed_jaccard_similarity(u1, u2) for u1, u2 in zip(users1, users2)]
+    np.testing.assert_allclose(user_simi.get_smoothed_jaccard_similarities(users1, users2), expected, rtol=1e-6)
@@ -0,0 +1,25 @@
+import numpy as np
+
+from src.clustering.split import split_matrix_kmeans, merge_splits_after_clustering
+
+
+def test_kmeans_split_drops_empty_clusters():
+    # Only 2 distinct rows, so k-means leaves at least 3 of the 5 clusters empty
+    matrix = np.repeat(np.array([[0., 0.], [1., 1.]]), [30, 20], axis=0)
+    groups, group_indices = split_matrix_kmeans(matrix, num_groups=5, max_group_size=40, trials=1)
+
+    assert sorted(len(group) for group in groups) == [20, 30]
+    np.testing.assert_array_equal(np.sort(np.concatenate(group_indices)), np.arange(50))
+    for group, indices in zip(groups, group_indices):
+        np.testing.assert_array_equal(group, matrix[indices])
+
+
+def test_merge_splits_maps_back_to_original_rows():
+    rng = np.random.RandomState(0)
+    matrix = np.concatenate([rng.normal(0, 0.1, (25, 3)), rng.normal(5, 0.1, (25, 3))])
+    groups, group_indices = split_matrix_kmeans(matrix, num_groups=2, max_group_size=30)
+
+    # One cluster per group holding all of its rows gives back every row once
+    clusters = [[list(range(len(group)))] for group in groups]
+    all_clusters = merge_splits_after_clustering(groups, group_indices, clusters)
+    assert sorted(user for cluster in all_clusters for user in cluster) == list(range(50))